@@ -0,0 +1,228 @@
+""" Benchmark of the queries and plots of the dashboard.
+
+Replays the requests made by the dashboard (filters, counts, recent models, searches with typical
+sidebar and query_string values, list pages, aggregations) and the construction of the DataFrame
+and figures of the Plots view, and measures the median and 95th percentile of each operation
+and of a full rerun of the dashboard.
+
+The requests are sent to a cluster, or to a stand-in replaying recorded responses (see standin.py):
+    # run against the cluster and record the responses
+    python benchmarks/bench_dashboard.py --record benchmarks/recording.json
+    # run against the recorded responses, with or without the recorded latency
+    python benchmarks/bench_dashboard.py --replay benchmarks/recording.json [--delay]
+
+The results are saved in benchmarks/results/<commit>.json, and can be compared with a previous run:
+    python benchmarks/bench_dashboard.py --replay benchmarks/recording.json --compare benchmarks/results/<commit>.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "dashboard"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import fdashboard as db
+from standin import RecordingClient, ReplayClient
+
+FACET_FIELDS = ["icompanion_star", "version", "Publication"]
+RANGE_FIELDS = ["eccentricity", "mass_ratio", "semi_major_axis", "period"]
+COUNT_FIELDS = [["eccentricity", "mass_ratio"], ["semi_major_axis", "mass_ratio"],
+                ["eccentricity", "semi_major_axis"],
+                ["eccentricity", "mass_ratio", "semi_major_axis"]]
+
+
+def get_client(url, **kwargs):
+    '''
+    Elasticsearch client, connected as in the dashboard. kwargs are passed to Elasticsearch
+    '''
+    import urllib3
+    from dotenv import load_dotenv
+    from elasticsearch import Elasticsearch
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    load_dotenv()
+    return Elasticsearch(url, api_key=os.getenv('API_KEY'), verify_certs=False, **kwargs)
+
+
+def scenarios(values, ranges) -> dict:
+    '''
+    Typical selections of the sidebar and search bar, {name: query}
+    '''
+    full = [ranges[field] for field in RANGE_FIELDS]
+    narrow = [(r[0], r[0] + (r[1] - r[0]) / 2) for r in full]
+    binaries = [v for v in values["icompanion_star"] if v != 0]
+    return {
+        "recent models": None,
+        "all models": db.build_query(None, *full, values["icompanion_star"], None),
+        "binaries": db.build_query(None, *full, binaries, values["Publication"]),
+        "narrow ranges": db.build_query(None, *narrow, binaries, None),
+        "query string": db.build_query("eccentricity:{0.2 TO 0.8} AND mass_ratio:>0.5",
+                                       *full, binaries, None),
+    }
+
+
+def rerun(client, index, query, field_types):
+    '''
+    Requests and computations of a full rerun of the dashboard, on the Plots view with the list displayed
+    '''
+    db.get_filters(index, client, FACET_FIELDS, RANGE_FIELDS)
+    db.count_hits(index, client, query)
+    db.fetch_page(index, client, 0, 10, query=query)
+    data = db.fetch_frame(index, client, db.PLOT_FIELDS, query=query,
+                          field_types=field_types)
+    build_figures(data)
+    for fields in COUNT_FIELDS:
+        db.get_counts(index, client, fields, query=query)
+
+
+def build_figures(data, density=False):
+    '''
+    Scatter plots of the Plots view
+    '''
+    data = data.astype({"icompanion_star": "string"})
+    return [
+        db.parameter_scatter(data, "eccentricity", "mass_ratio", "semi_major_axis",
+                             color="icompanion_star", density=density),
+        db.parameter_scatter(data, "eccentricity", "mass_ratio", "period",
+                             color="icompanion_star", density=density),
+        db.parameter_scatter(data, "wind_terminal_velocity", "wind_mass_rate",
+                             color="icompanion_star", density=density),
+    ]
+
+
+def operations(client, index, field_types) -> dict:
+    '''
+    Operations to measure, {name: function without arguments}
+    '''
+    values, ranges = db.get_filters(index, client, FACET_FIELDS, RANGE_FIELDS)
+    ops = {
+        "filters": lambda: db.get_filters(index, client, FACET_FIELDS, RANGE_FIELDS),
+        "recent data": lambda: db.fetch_recent_data(index, client, size=1000),
+    }
+    for name, query in scenarios(values, ranges).items():
+        sort = db.RECENT_SORT if query is None else None
+        ops[f"count | {name}"] = lambda q=query: db.count_hits(index, client, q)
+        ops[f"fetch data | {name}"] = lambda q=query, s=sort: db.fetch_frame(
+            index, client, db.PLOT_FIELDS, query=q, sort=s)
+        ops[f"list page | {name}"] = lambda q=query, s=sort: db.fetch_page(
+            index, client, 0, 10, query=q, sort=s)
+        ops[f"counts aggregation | {name}"] = lambda q=query: [
+            db.get_counts(index, client, fields, query=q) for fields in COUNT_FIELDS]
+        ops[f"full rerun | {name}"] = lambda q=query: rerun(client, index, q, field_types)
+
+    # DataFrame and figures, without requests
+    pages = list(db.fetch_pages(index, client, fields=db.PLOT_FIELDS))
+    data = db.pages_to_frame(pages, db.PLOT_FIELDS, field_types=field_types)
+    ops["build dataframe"] = lambda: db.pages_to_frame(pages, db.PLOT_FIELDS,
+                                                       field_types=field_types)
+    ops["build figures"] = lambda: build_figures(data)
+    ops["build figures (density)"] = lambda: build_figures(data, density=True)
+    return ops
+
+
+def measure(function, repeat) -> dict:
+    '''
+    Run a function repeat times (after a warm up run), and return the statistics of the durations in ms
+    '''
+    import numpy as np
+
+    function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50": float(np.percentile(durations, 50)),
+        "p95": float(np.percentile(durations, 95)),
+        "mean": float(np.mean(durations)),
+        "n": repeat
+    }
+
+
+def commit() -> str:
+    '''
+    Short hash of the current commit
+    '''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, reference):
+    '''
+    Print the median and 95th percentile of each operation next to a reference run
+    '''
+    print(f"\n{'operation':45s} {'p50 ref':>9s} {'p50':>9s} {'p95 ref':>9s} {'p95':>9s} {'ratio':>6s}")
+    for name, stats in results["operations"].items():
+        ref = reference["operations"].get(name)
+        if ref is None:
+            continue
+        print(f"{name:45s} {ref['p50']:9.2f} {stats['p50']:9.2f} {ref['p95']:9.2f} "
+              + f"{stats['p95']:9.2f} {stats['p50'] / ref['p50']:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://localhost:9200/", help="url of the cluster")
+    parser.add_argument("--index", default="wind", help="index queried")
+    parser.add_argument("--record", help="record the responses of the cluster to this file")
+    parser.add_argument("--replay", help="replay the responses recorded in this file")
+    parser.add_argument("--delay", action="store_true",
+                        help="when replaying, wait as long as the recorded requests took")
+    parser.add_argument("--repeat", type=int, default=20, help="number of runs of each operation")
+    parser.add_argument("--output", default=os.path.join(ROOT, "benchmarks", "results"),
+                        help="directory of the results")
+    parser.add_argument("--compare", help="results file of a previous run to compare with")
+    args = parser.parse_args()
+
+    if args.replay:
+        client = ReplayClient(args.replay, delay=args.delay)
+        backend = f"replay {os.path.basename(args.replay)}" + (" with delay" if args.delay else "")
+    else:
+        client = get_client(args.url)
+        backend = args.url
+        if args.record:
+            client = RecordingClient(client)
+
+    field_types = db.read_field_types(os.path.join(ROOT, "metadata.csv"))
+    results = {
+        "commit": commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "backend": backend,
+        "index": args.index,
+        "operations": {}
+    }
+    for name, function in operations(client, args.index, field_types).items():
+        stats = measure(function, args.repeat)
+        results["operations"][name] = stats
+        print(f"{name:45s} p50 {stats['p50']:9.2f} ms   p95 {stats['p95']:9.2f} ms")
+
+    if args.record:
+        client.save(args.record)
+    if args.replay and client.misses:
+        # the dashboard functions report errors with st.error and return empty results
+        print(f"\nWarning: {client.misses} requests were not recorded, record again with --record")
+        results["misses"] = client.misses
+    os.makedirs(args.output, exist_ok=True)
+    output = os.path.join(args.output, f"{results['commit']}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"\nResults saved in {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
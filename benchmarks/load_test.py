@@ -0,0 +1,293 @@
+""" Load test of the query layer of the dashboard with several concurrent users.
+
+Simulates sessions of the dashboard, each in its own thread and sharing one Elasticsearch client as
+the dashboard does. Each session reruns the dashboard (opening it, searching, paging the list,
+looking at the plots) with a random think time between reruns, using the functions of fdashboard.
+Reports the throughput, the latency percentiles of the reruns and of the requests, the time taken
+by Elasticsearch ("took") and the use of the connection pool of the client.
+
+    # 10 users during 2 minutes against the cluster, 5 s of think time on average
+    python benchmarks/load_test.py --sessions 10 --duration 120 --think 5
+    # against the recorded responses of the cluster (see standin.py), with the recorded latency
+    python benchmarks/load_test.py --record benchmarks/load.json
+    python benchmarks/load_test.py --replay benchmarks/load.json --delay
+
+The filters, plot data and counts are cached for --cache-ttl seconds and shared by the sessions,
+as in dashboard.py. Use --cache-ttl 0 to measure without caching.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dashboard"))
+
+from bench_dashboard import (COUNT_FIELDS, FACET_FIELDS, RANGE_FIELDS, ROOT, build_figures,
+                             commit, get_client, scenarios)
+from standin import METHODS, RecordingClient, ReplayClient
+
+import fdashboard as db
+
+# relative frequency of the actions of a user
+ACTIONS = {"home": 1, "search": 4, "page": 3, "plots": 2}
+
+
+class MeteredClient:
+    '''
+    Wraps a client to measure the duration of the requests, the time taken by Elasticsearch
+    and the number of requests in flight, which is compared to the size of the connection pool.
+    '''
+
+    def __init__(self, client, pool_size):
+        self.client = client
+        self.pool_size = pool_size
+        self.durations = {}
+        self.took = []
+        self.errors = 0
+        self.in_flight = 0
+        self.peak = 0
+        # time spent with at least pool_size requests in flight
+        self.saturated = 0.0
+        self._saturated_since = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            return getattr(self.client, name)
+
+        def call(**kwargs):
+            with self._lock:
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+                if self.in_flight >= self.pool_size and self._saturated_since is None:
+                    self._saturated_since = time.perf_counter()
+            start = time.perf_counter()
+            try:
+                response = getattr(self.client, name)(**kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                raise
+            finally:
+                end = time.perf_counter()
+                with self._lock:
+                    self.in_flight -= 1
+                    self.durations.setdefault(name, []).append((end - start) * 1000)
+                    if self.in_flight < self.pool_size and self._saturated_since is not None:
+                        self.saturated += end - self._saturated_since
+                        self._saturated_since = None
+            if 'took' in response:
+                with self._lock:
+                    self.took.append(response['took'])
+            return response
+
+        return call
+
+
+class SharedCache:
+    '''
+    Cache shared by the sessions with a time to live, in place of st.cache_data
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, function):
+        if self.ttl <= 0:
+            return function()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = function()
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+        return value
+
+
+def session(number, client, index, cache, field_types, args, stop, reruns):
+    '''
+    One user of the dashboard, rerunning it until stop is set.
+    Appends (action, duration in ms) to reruns for each rerun.
+    '''
+    rng = random.Random(args.seed + number)
+    query, page = None, 0
+
+    def filters():
+        return cache.get(("filters", index),
+                         lambda: db.get_filters(index, client, FACET_FIELDS, RANGE_FIELDS))
+
+    action = "home"
+    # users don't all open the dashboard at the same time
+    time.sleep(rng.uniform(0, args.ramp_up))
+    while not stop.is_set():
+        start = time.perf_counter()
+        values, ranges = filters()
+        if action == "home":
+            query, page = None, 0
+            db.fetch_recent_data(index, client, size=1000)
+        elif action == "search":
+            query = rng.choice(list(scenarios(values, ranges).values()))
+            page = 0
+            db.fetch_page(index, client, page, 10, query=query,
+                          sort=db.RECENT_SORT if query is None else None)
+        elif action == "page":
+            page += 1
+            db.fetch_page(index, client, page, 10, query=query,
+                          sort=db.RECENT_SORT if query is None else None)
+        elif action == "plots":
+            key = json.dumps(query, sort_keys=True)
+            data = cache.get(("plot data", key), lambda: db.fetch_frame(
+                index, client, db.PLOT_FIELDS, query=query, field_types=field_types))
+            build_figures(data)
+            for fields in COUNT_FIELDS:
+                cache.get(("counts", key, tuple(fields)),
+                          lambda f=fields: db.get_counts(index, client, f, query=query))
+        # model count in the footer of every rerun
+        db.count_hits(index, client, query)
+        reruns.append((action, (time.perf_counter() - start) * 1000))
+
+        action = rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+        stop.wait(rng.expovariate(1 / args.think) if args.think > 0 else 0)
+
+
+def percentiles(values) -> dict:
+    '''
+    Median, 95th and 99th percentiles and mean of a list of values
+    '''
+    import numpy as np
+
+    if not values:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(np.mean(values))
+    }
+
+
+def report(results):
+    '''
+    Print the results of a load test
+    '''
+    print(f"\n{results['sessions']} sessions during {results['duration']:.0f} s, "
+          + f"{results['reruns']} reruns, {results['requests']} requests")
+    print(f"throughput: {results['reruns_per_s']:.2f} reruns/s, "
+          + f"{results['requests_per_s']:.2f} requests/s")
+    print(f"\n{'':28s} {'n':>7s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s}")
+    for group in ["rerun", "request", "took"]:
+        for name, stats in results[group].items():
+            if stats["n"]:
+                print(f"{group + ' ' + name:28s} {stats['n']:7d} {stats['p50']:9.1f} "
+                      + f"{stats['p95']:9.1f} {stats['p99']:9.1f}")
+    pool = results["pool"]
+    print(f"\nconnection pool: {pool['size']} connections, peak {pool['peak']} requests in flight, "
+          + f"saturated {100 * pool['saturated_fraction']:.1f}% of the time")
+    print(f"cache: {results['cache']['hits']} hits, {results['cache']['misses']} misses")
+    if results["errors"]:
+        print(f"errors: {results['errors']} failed requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://localhost:9200/", help="url of the cluster")
+    parser.add_argument("--index", default="wind", help="index queried")
+    parser.add_argument("--sessions", type=int, default=10, help="number of concurrent users")
+    parser.add_argument("--duration", type=float, default=60, help="duration of the test in s")
+    parser.add_argument("--think", type=float, default=5,
+                        help="mean think time between the reruns of a user in s")
+    parser.add_argument("--ramp-up", type=float, default=5,
+                        help="the users start within this time in s")
+    parser.add_argument("--connections", type=int, default=10,
+                        help="connections per node of the client (connections_per_node)")
+    parser.add_argument("--cache-ttl", type=float, default=300,
+                        help="time to live of the shared cache in s, 0 to disable it")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the actions of the users")
+    parser.add_argument("--record", help="record the responses of the cluster to this file")
+    parser.add_argument("--replay", help="replay the responses recorded in this file")
+    parser.add_argument("--delay", action="store_true",
+                        help="when replaying, wait as long as the recorded requests took")
+    parser.add_argument("--output", help="json file to save the results to")
+    args = parser.parse_args()
+
+    if args.replay:
+        client = ReplayClient(args.replay, delay=args.delay)
+    else:
+        client = get_client(args.url, connections_per_node=args.connections)
+        if args.record:
+            client = RecordingClient(client)
+    metered = MeteredClient(client, args.connections)
+    cache = SharedCache(args.cache_ttl)
+    field_types = db.read_field_types(os.path.join(ROOT, "metadata.csv"))
+
+    stop = threading.Event()
+    reruns = []
+    threads = [
+        threading.Thread(target=session,
+                         args=(i, metered, args.index, cache, field_types, args, stop, reruns),
+                         daemon=True)
+        for i in range(args.sessions)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    stop.wait(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    if metered._saturated_since is not None:
+        metered.saturated += time.perf_counter() - metered._saturated_since
+
+    requests = sum(len(durations) for durations in metered.durations.values())
+    results = {
+        "commit": commit(),
+        "backend": f"replay {os.path.basename(args.replay)}" if args.replay else args.url,
+        "sessions": args.sessions,
+        "think": args.think,
+        "duration": duration,
+        "reruns": len(reruns),
+        "requests": requests,
+        "reruns_per_s": len(reruns) / duration,
+        "requests_per_s": requests / duration,
+        "rerun": {"all": percentiles([d for _, d in reruns])}
+        | {action: percentiles([d for a, d in reruns if a == action]) for action in ACTIONS},
+        "request": {name: percentiles(durations)
+                    for name, durations in sorted(metered.durations.items())},
+        "took": {"search": percentiles(metered.took)},
+        "pool": {
+            "size": args.connections,
+            "peak": metered.peak,
+            "saturated_fraction": metered.saturated / duration
+        },
+        "cache": {"hits": cache.hits, "misses": cache.misses},
+        "errors": metered.errors
+    }
+    report(results)
+    if args.replay and client.misses:
+        print(f"Warning: {client.misses} requests were not recorded, record again with --record "
+              + "and the same --seed")
+
+    if args.record:
+        client.save(args.record)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
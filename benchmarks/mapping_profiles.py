@@ -0,0 +1,159 @@
+""" Size and latency of the index with and without the indexing profiles of metadata.csv.
+
+Copies an index (reindex) into two temporary indices, one with every field fully indexed, and one
+with the indexing profiles of metadata.csv (doc values only fields, scaled floats, index sorted
+by model date, see create_mapping and create_settings in load_func.py). Reports the time taken
+to index the documents, the size of the indices and of their largest fields, and the latency
+of the requests of the dashboard on each index.
+
+    python benchmarks/mapping_profiles.py --index wind --repeat 20
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dashboard"))
+
+from bench_dashboard import (COUNT_FIELDS, FACET_FIELDS, RANGE_FIELDS, ROOT, commit, get_client,
+                             measure, scenarios)
+
+sys.path.append(ROOT)
+
+import fdashboard as db
+from load_func import BULK_LOAD_SETTINGS, create_mapping, create_settings, read_csv
+
+
+def definitions() -> dict:
+    '''
+    Index definitions compared, {name: index_definition}
+    '''
+    data, header = read_csv(os.path.join(ROOT, "metadata.csv"))
+    return {
+        "full": {
+            "settings": {"number_of_shards": 1},
+            "mappings": {"properties": create_mapping(data, header, profiles=False)}
+        },
+        "profiles": {
+            "settings": create_settings(data, header, {"number_of_shards": 1}),
+            "mappings": {"properties": create_mapping(data, header)}
+        },
+    }
+
+
+def copy_index(client, source, index, index_definition) -> float:
+    '''
+    Copy the documents of source into a new index, and return the time taken in s
+    '''
+    client.indices.create(index=index,
+                          settings=index_definition["settings"] | BULK_LOAD_SETTINGS,
+                          mappings=index_definition["mappings"])
+    start = time.perf_counter()
+    client.reindex(source={"index": source}, dest={"index": index},
+                   wait_for_completion=True, refresh=True)
+    seconds = time.perf_counter() - start
+    client.indices.forcemerge(index=index, max_num_segments=1)
+    return seconds
+
+
+def disk_usage(client, index, top=10) -> dict:
+    '''
+    Size of the index and of its largest fields in bytes
+    '''
+    stats = client.indices.stats(index=index, metric="store,docs")["indices"][index]["primaries"]
+    usage = client.indices.disk_usage(index=index, run_expensive_tasks=True)[index]
+    # metadata fields (_id, _source, ...) are the same in both indices
+    fields = sorted([(field, values["total_in_bytes"]) for field, values in usage["fields"].items()
+                     if not field.startswith("_")], key=lambda item: -item[1])
+    return {
+        "documents": stats["docs"]["count"],
+        "store": stats["store"]["size_in_bytes"],
+        "fields": dict(fields[:top])
+    }
+
+
+def latencies(client, index, queries, repeat) -> dict:
+    '''
+    Latency of the requests of the dashboard on an index, {operation: statistics in ms}
+    '''
+    ops = {
+        "recent data": lambda: db.fetch_recent_data(index, client, size=1000),
+        "recent page": lambda: db.fetch_page(index, client, 0, 10, sort=db.RECENT_SORT),
+        "filters": lambda: db.get_filters(index, client, FACET_FIELDS, RANGE_FIELDS),
+    }
+    for name, query in queries.items():
+        ops[f"count | {name}"] = lambda q=query: db.count_hits(index, client, q)
+        ops[f"fetch data | {name}"] = lambda q=query: db.fetch_frame(
+            index, client, db.PLOT_FIELDS, query=q)
+        ops[f"counts aggregation | {name}"] = lambda q=query: [
+            db.get_counts(index, client, fields, query=q) for fields in COUNT_FIELDS]
+    results = {name: measure(function, repeat) for name, function in ops.items()}
+    # the number of hits should not change with the profiles (scaled floats are rounded)
+    for name, query in queries.items():
+        results[f"count | {name}"]["hits"] = db.count_hits(index, client, query)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="https://localhost:9200/", help="url of the cluster")
+    parser.add_argument("--index", default="wind", help="index (or alias) copied")
+    parser.add_argument("--repeat", type=int, default=20, help="number of runs of each request")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary indices")
+    parser.add_argument("--output", default=os.path.join(ROOT, "benchmarks", "results"),
+                        help="directory of the results")
+    args = parser.parse_args()
+
+    client = get_client(args.url)
+    values, ranges = db.get_filters(args.index, client, FACET_FIELDS, RANGE_FIELDS)
+    queries = scenarios(values, ranges)
+
+    results = {"commit": commit(), "index": args.index, "profiles": {}}
+    for name, index_definition in definitions().items():
+        index = f"{args.index}_profile_{name}"
+        if client.indices.exists(index=index):
+            client.indices.delete(index=index)
+        try:
+            seconds = copy_index(client, args.index, index, index_definition)
+            results["profiles"][name] = {
+                "indexing_seconds": seconds,
+                "size": disk_usage(client, index),
+                "latency": latencies(client, index, queries, args.repeat)
+            }
+        finally:
+            if not args.keep:
+                client.indices.delete(index=index, ignore_unavailable=True)
+
+    full, profiles = results["profiles"]["full"], results["profiles"]["profiles"]
+    print(f"{'':40s} {'full':>12s} {'profiles':>12s} {'ratio':>6s}")
+    print(f"{'indexing time (s)':40s} {full['indexing_seconds']:12.2f} "
+          + f"{profiles['indexing_seconds']:12.2f} "
+          + f"{profiles['indexing_seconds'] / full['indexing_seconds']:6.2f}")
+    print(f"{'store size (kB)':40s} {full['size']['store'] / 1e3:12.1f} "
+          + f"{profiles['size']['store'] / 1e3:12.1f} "
+          + f"{profiles['size']['store'] / full['size']['store']:6.2f}")
+    for field, size in full["size"]["fields"].items():
+        other = profiles["size"]["fields"].get(field)
+        print(f"{'  ' + field + ' (kB)':40s} {size / 1e3:12.1f} "
+              + (f"{other / 1e3:12.1f}" if other is not None else f"{'-':>12s}"))
+    print(f"\n{'p50 latency (ms)':40s}")
+    for operation, stats in full["latency"].items():
+        other = profiles["latency"][operation]
+        print(f"{operation:40s} {stats['p50']:12.2f} {other['p50']:12.2f} "
+              + f"{other['p50'] / stats['p50']:6.2f}")
+        if stats.get("hits") != other.get("hits"):
+            print(f"{'':40s} warning: {stats['hits']} hits without profiles, {other['hits']} with")
+
+    os.makedirs(args.output, exist_ok=True)
+    output = os.path.join(args.output, f"mapping_profiles_{results['commit']}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print(f"\nResults saved in {output}")
+
+
+if __name__ == "__main__":
+    main()
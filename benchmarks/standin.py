@@ -0,0 +1,114 @@
+""" Stand-in for the Elasticsearch cluster used by the benchmarks.
+RecordingClient records the requests made to a real cluster and their responses,
+ReplayClient replays them later without any cluster. """
+
+import json
+import threading
+import time
+
+# client methods used by the dashboard
+METHODS = ["search", "count", "mget", "open_point_in_time", "close_point_in_time", "info"]
+
+
+class NotRecordedError(Exception):
+    '''
+    Raised by ReplayClient for a request that was not recorded
+    '''
+
+
+# replaces the point in time ids in the keys of the requests
+PIT_PLACEHOLDER = "<pit>"
+
+
+def request_key(method, kwargs) -> str:
+    '''
+    Key identifying a request in the recordings.
+    The point in time ids are left out: they differ between runs and between concurrent
+    sessions, which would then have to replay their requests in the recorded order.
+    '''
+    kwargs = dict(kwargs)
+    if method == "close_point_in_time" and "id" in kwargs:
+        kwargs["id"] = PIT_PLACEHOLDER
+    if "pit" in kwargs:
+        kwargs["pit"] = {**kwargs["pit"], "id": PIT_PLACEHOLDER}
+    body = kwargs.get("body")
+    if isinstance(body, dict) and "pit" in body:
+        kwargs["body"] = {**body, "pit": {**body["pit"], "id": PIT_PLACEHOLDER}}
+    return method + " " + json.dumps(kwargs, sort_keys=True, default=str)
+
+
+class RecordingClient:
+    '''
+    Wraps an Elasticsearch client and records the requests made with it, their responses
+    and the time they took. The recordings are written to a json file with save.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            return getattr(self.client, name)
+
+        def call(**kwargs):
+            start = time.perf_counter()
+            response = getattr(self.client, name)(**kwargs)
+            seconds = time.perf_counter() - start
+            # ObjectApiResponse -> dict
+            body = getattr(response, "body", response)
+            with self._lock:
+                self.records.setdefault(request_key(name, kwargs), []).append({
+                    "response": body,
+                    "seconds": seconds
+                })
+            return response
+
+        return call
+
+    def save(self, file):
+        '''
+        Write the recordings to a json file
+        '''
+        with self._lock:
+            with open(file, "w") as f:
+                json.dump(self.records, f)
+
+
+class ReplayClient:
+    '''
+    Replays recorded responses (see RecordingClient) in place of an Elasticsearch client.
+    Requests recorded several times get their responses in turn.
+    Args:
+        file: json file of the recordings
+        delay: if True, wait as long as the request took when it was recorded, to
+               mimic the latency of the cluster. Otherwise only the client side is measured.
+    '''
+
+    def __init__(self, file, delay=False):
+        with open(file) as f:
+            self.records = json.load(f)
+        self.delay = delay
+        self.misses = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            key = request_key(name, kwargs)
+            with self._lock:
+                if key not in self.records:
+                    self.misses += 1
+                    raise NotRecordedError(f"Request not recorded: {key[:200]}")
+                n = self._calls.get(key, 0)
+                self._calls[key] = n + 1
+                record = self.records[key][n % len(self.records[key])]
+            if self.delay:
+                time.sleep(record["seconds"])
+            return record["response"]
+
+        return call
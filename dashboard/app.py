@@ -0,0 +1,40 @@
+""" Dashboard with its download route, run with 'streamlit run dashboard/app.py'
+
+The archives of the models selected in the dashboard (see iter_bundle in fdashboard.py) are
+streamed by the /bundle route while they are built, instead of going through st.download_button,
+which holds the whole file in memory.
+"""
+
+import os
+import sys
+
+import streamlit as st
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+# same module as the one imported by dashboard.py, which registers the download links
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# load_func.py, used to read the models stored in archives
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fdashboard as db
+
+
+async def bundle(request):
+    '''
+    Stream the archive of a download link created in the list view
+    '''
+    chunks = db.bundle_chunks(request.path_params["token"])
+    if chunks is None:
+        return PlainTextResponse("This download link has expired, create a new one in the dashboard.",
+                                 status_code=404)
+    # the generator is run in a thread, one chunk at a time
+    return StreamingResponse(chunks,
+                             media_type="application/gzip",
+                             headers={"Content-Disposition": 'attachment; filename="models.tar.gz"'})
+
+
+db.BUNDLE_ROUTE = "/bundle"
+
+app = st.App(os.path.join(os.path.dirname(os.path.abspath(__file__)), "dashboard.py"),
+             routes=[Route(db.BUNDLE_ROUTE + "/{token}", bundle)])
@@ -1,23 +1,23 @@
 """ test of streamlit dahsboard"""
 
+import time
+
+# used to measure the time to first paint
+start_time = time.perf_counter()
+
+import json
 import os
-from datetime import datetime
+import sys
 
-import altair as alt
-import pandas as pd
-import plotly.express as px
-import numpy as np
 import streamlit as st
 
-from dotenv import load_dotenv
-from elasticsearch import Elasticsearch
-from streamlit_js_eval import streamlit_js_eval
-
 import fdashboard as db
 
-import urllib3
+# the functions used to upload the models (load_func.py) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Heavy libraries (elasticsearch, pandas, plotly, ...) are imported where they are used,
+# so the page shell is displayed before they are loaded
 
 # app settings
 st.set_page_config(page_title="Test Dashboard",
@@ -26,19 +26,12 @@ st.set_page_config(page_title="Test Dashboard",
                    initial_sidebar_state="expanded"
                    )
 
-alt.themes.enable("dark")
-
-load_dotenv()
-# for now it uses my api key, but eventually I'll create one just for the dashboar
-client = Elasticsearch("https://localhost:9200/",
-                       api_key=os.getenv('API_KEY'),
-                       verify_certs=False)
-
 # CSV path to provide details on the index mappings
 csv_path = "/Users/camille/Documents/PhantomDatabase/metadata.csv"
 
 # Define data labels needed for dataframe
 # format is -> {elastic_field_name: "Label to display"}
+# (keep db.PLOT_FIELDS in sync, only these fields are fetched for the plots)
 dlabels = {
     "eccentricity": "Eccentricity",
     "mass_ratio": "Mass ratio",
@@ -53,15 +46,6 @@ dlabels = {
 if "display" not in st.session_state:
     st.session_state["display"] = False
 
-# page length (used for column placements)
-page_width = streamlit_js_eval(
-    js_expressions='window.innerWidth',
-    key='WIDTH',
-    want_output=True,
-)
-if not page_width:
-    page_width = 800  # default page width value to prevent complaining about Nonetype
-
 db.remove_upper_padding(
 )  # workaround for padding issues at the top, may need to change in the future
 
@@ -72,66 +56,21 @@ st.sidebar.title("Welcome to the jungle! 🌴")
 #index selector
 selected_index = st.sidebar.selectbox("Elasticsearch Index", ["wind"],
                                       key="selected_index")
-st.session_state['display'] = False
-
-# number of companions selector
-icomp = db.get_field_values(selected_index, client, "icompanion_star")
-icompanion = st.sidebar.multiselect("Number of companions",
-    icomp,icomp,key='icompanion_star')
-
-# get range of binary parameters in index
-ranges = {
-    "eccentricity": [0.0, 1.0],
-    "mass_ratio": [0.0, 2.0],
-    "semi_major_axis": [2.0, 215.0],
-    "period": [2.0, 2000.0]
-}
-for range in ranges.keys():
-    ranges[range] = db.get_range(selected_index, client, range)
-
-# Add range sliders for binary parameters
-if 0 in icompanion:
-    # disable them for single stars/ all models (i.e. minumum number of companions of 0)
-    disable = True
-else:
-    disable = False
-
-eccentricity = st.sidebar.slider(
-    "Eccentricity range",
-    ranges['eccentricity'][0],
-    ranges['eccentricity'][1],
-    (ranges['eccentricity'][0], ranges['eccentricity'][1]),
-    disabled=disable)
-massratio = st.sidebar.slider(
-    "Mass ratio range",
-    ranges['mass_ratio'][0],
-    ranges['mass_ratio'][1],
-    (ranges['mass_ratio'][0], ranges['mass_ratio'][1]),
-    disabled=disable)
-sma = st.sidebar.slider(
-    "Semi-major axis range",
-    ranges['semi_major_axis'][0],
-    ranges['semi_major_axis'][1],
-    (ranges['semi_major_axis'][0], ranges['semi_major_axis'][1]),
-    disabled=disable)
-period = st.sidebar.slider("Orbital period range",
-                           ranges['period'][0],
-                           ranges['period'][1],
-                           (ranges['period'][0], ranges['period'][1]),
-                           disabled=disable)
-
-# immediate fetch of recent data, before making queries, maybe uneccessary
-if 'search_results' not in st.session_state:
-    st.session_state['search_results'] = db.fetch_recent_data(selected_index,
-                                                              client,
-                                                              size=1000)
-manual_query = None
+
+# the filters are added once the values and ranges of the fields are loaded
+filters = st.sidebar.container()
+loading_filters = filters.empty()
+loading_filters.caption("Loading filters...")
 
 
 ##### TABS #####
-home, search, list, plots = st.tabs(["Home", "Search", "List", "Plots"])
+# only the selected view is computed (st.tabs would run all of them at each rerun)
+view = st.radio("View", ["Home", "Search", "List", "Plots"],
+                horizontal=True,
+                label_visibility="collapsed",
+                key="view")
 
-with home:
+if view == "Home":
     st.header("Hi")
     st.write('''We can add more information here later on.  
              Some details for the users, maybe a brief description of the database,
@@ -141,8 +80,329 @@ with home:
     st.write("Also we can add a small tutorial on how to make queries using the python API, for people who want more specific queries.")
     st.write('''If you have any questions or suggestions, please contact the database administrator.''')
 
+# the page shell is displayed, everything below waits for the data
+first_paint = time.perf_counter() - start_time
+
+
+##### DATA #####
+
+# snapshot of the index saved after each upload (see SaveSnapshot in load_func.py),
+# used when Elasticsearch is unavailable or too slow
+snapshot_path = os.path.join(os.path.dirname(csv_path), "snapshot.sqlite")
+
+
+@st.cache_resource
+def get_client():
+    '''
+    Elasticsearch client, created once and shared by all sessions.
+    If there is a snapshot, the requests are answered from it while the cluster is unavailable
+    '''
+    import urllib3
+    from dotenv import load_dotenv
+    from elasticsearch import Elasticsearch
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    load_dotenv()
+    # for now it uses my api key, but eventually I'll create one just for the dashboar
+    client = Elasticsearch("https://localhost:9200/",
+                           api_key=os.getenv('API_KEY'),
+                           verify_certs=False)
+    if not os.path.exists(snapshot_path):
+        return client
+
+    from snapshot import FallbackClient
+
+    # the snapshot is loaded in the background, ready if the cluster doesn't answer
+    return FallbackClient(client, snapshot_path)
+
+
+def get_filters(index_name, client) -> tuple:
+    '''
+    Values of the keyword filters and ranges of the binary parameters
+    '''
+    return db.get_filters(
+        index_name, client,
+        ["icompanion_star", "version", "Publication"],
+        ["eccentricity", "mass_ratio", "semi_major_axis", "period"])
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def cluster_filters(index_name):
+    '''
+    Filters from the cluster, refreshed every 5 minutes
+    '''
+    return get_filters(index_name, get_client())
+
+
+@st.cache_data(show_spinner=False)
+def snapshot_filters(index_name):
+    '''
+    Filters from the snapshot, used until the cluster answers
+    '''
+    return get_filters(index_name, get_client().snapshot)
+
+
+@st.cache_resource(ttl=300, show_spinner=False)
+def background_filters(index_name):
+    '''
+    Filters from the cluster (or the snapshot if it is unavailable) loaded in a thread,
+    refreshed every 5 minutes. Returns a Future
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(get_filters, index_name, get_client())
+    pool.shutdown(wait=False)
+    return future
+
+
+@st.cache_resource
+def latest_filters() -> dict:
+    '''
+    Latest filters loaded in the background, {index name: (values, ranges)}
+    '''
+    return {}
+
+
+def load_filters(index_name):
+    '''
+    Values of the keyword filters and ranges of the binary parameters.
+    With a snapshot, the sidebar doesn't wait for the cluster (up to the time budget of
+    FallbackClient if it is down): the filters are filled from the snapshot until the
+    cluster answers in the background.
+    '''
+    client = get_client()
+    if not hasattr(client, "snapshot"):
+        return cluster_filters(index_name)
+    future = background_filters(index_name)
+    if future.done() and future.exception() is None:
+        latest_filters()[index_name] = future.result()
+    if index_name in latest_filters():
+        return latest_filters()[index_name]
+    from snapshot import SnapshotError
+
+    try:
+        return snapshot_filters(index_name)
+    except SnapshotError:
+        return future.result()
+
+
+client = get_client()
+field_values, ranges = load_filters(selected_index)
+loading_filters.empty()
+
+# the most recent models are shown before making queries.
+# Only the query is stored, results are fetched page by page when they are displayed
+if 'search_request' not in st.session_state:
+    st.session_state['search_request'] = {"query": None, "sort": db.RECENT_SORT}
+# page of the model list currently displayed
+if 'list_page' not in st.session_state:
+    st.session_state['list_page'] = 0
+if 'page_size' not in st.session_state:
+    st.session_state['page_size'] = 10
+# default selections of the keyword filters
+if 'version' not in st.session_state:
+    st.session_state['version'] = field_values["version"]
+if 'publication' not in st.session_state:
+    st.session_state['publication'] = field_values["Publication"]
+# streamlit forgets the state of widgets that are not displayed,
+# so keep the state of the widgets of the hidden views
+for key in ["manual_query", "version", "publication", "page_size",
+            "bundle_images", "bundle_ev", "find_model"]:
+    if key in st.session_state:
+        st.session_state[key] = st.session_state[key]
+
+
+##### VIEWS #####
+# Each part of the page is a fragment: a widget change only reruns the fragment it belongs to.
+# The query is only changed by the Apply and Search buttons, which rerun the whole page.
+
+def current_query():
+    '''
+    Build the query from the sidebar filters and the search tab selections
+    '''
+    return db.build_query(st.session_state.get("manual_query"),
+                          st.session_state["eccentricity_range"],
+                          st.session_state["mass_ratio_range"],
+                          st.session_state["semi_major_axis_range"],
+                          st.session_state["period_range"],
+                          st.session_state["icompanion_star"],
+                          st.session_state.get("publication"))
+
+
+def apply_query():
+    '''
+    Store the current query and rerun the whole page to update the views
+    '''
+    st.session_state['search_request'] = {"query": current_query(), "sort": None}
+    st.session_state['list_page'] = 0
+    st.rerun()
+
+
+@st.fragment
+def sidebar_filters(field_values, ranges):
+    # number of companions selector
+    icomp = field_values["icompanion_star"]
+    icompanion = st.multiselect("Number of companions",
+        icomp,icomp,key='icompanion_star')
+
+    # Add range sliders for binary parameters
+    if 0 in icompanion:
+        # disable them for single stars/ all models (i.e. minumum number of companions of 0)
+        disable = True
+    else:
+        disable = False
+
+    st.slider(
+        "Eccentricity range",
+        ranges['eccentricity'][0],
+        ranges['eccentricity'][1],
+        (ranges['eccentricity'][0], ranges['eccentricity'][1]),
+        disabled=disable,
+        key="eccentricity_range")
+    st.slider(
+        "Mass ratio range",
+        ranges['mass_ratio'][0],
+        ranges['mass_ratio'][1],
+        (ranges['mass_ratio'][0], ranges['mass_ratio'][1]),
+        disabled=disable,
+        key="mass_ratio_range")
+    st.slider(
+        "Semi-major axis range",
+        ranges['semi_major_axis'][0],
+        ranges['semi_major_axis'][1],
+        (ranges['semi_major_axis'][0], ranges['semi_major_axis'][1]),
+        disabled=disable,
+        key="semi_major_axis_range")
+    st.slider("Orbital period range",
+              ranges['period'][0],
+              ranges['period'][1],
+              (ranges['period'][0], ranges['period'][1]),
+              disabled=disable,
+              key="period_range")
+
+    # search button in the sidebar
+    col1_, col2_, col3_ = st.columns([1, 1, 1])
+    with col1_:
+        pass
+    with col2_:
+        if st.button("Apply"):
+            st.session_state["display"] = True
+            apply_query()
+    with col3_:
+        pass
+
+
+@st.cache_resource(ttl=300, show_spinner=False)
+def similarity_index(index_name):
+    '''
+    Local index of the parameter vectors, used if the cluster can't run kNN queries
+    '''
+    import load_func as lf
+    return lf.SimilarityIndex.from_index(get_client(), index_name)
+
+
+def similar_models_panel(selected_index):
+    '''
+    Find the models closest to a model or to a set of parameters
+    '''
+    import load_func as lf
+
+    st.write('''Find the models with the closest parameters to a given model, or to a set of parameters.
+             The distance is computed on the parameters below, scaled between 0 and 1 within their usual range.''')
+    mode = st.radio("Compare to", ["Model", "Parameters"], horizontal=True,
+                    key="similar_mode")
+    if mode == "Model":
+        target = st.text_input("Model name", key="similar_model")
+    else:
+        target = {}
+        columns = st.columns(len(lf.SIMILARITY_FIELDS))
+        for col_, (field, (vmin, vmax, log)) in zip(columns,
+                                                     lf.SIMILARITY_FIELDS.items()):
+            with col_:
+                target[field] = st.number_input(field,
+                                                value=vmin,
+                                                format="%g",
+                                                key=f"similar_{field}")
+    k = st.slider("Number of models", 1, 50, 10, key="similar_k")
+
+    if st.button("Find similar models") and target:
+        st.session_state['similar_models'] = lf.find_similar(
+            get_client(), selected_index, target, k,
+            local_index=lambda: similarity_index(selected_index))
+    if st.session_state.get('similar_models'):
+        st.dataframe(
+            [{"Model name": name, "Distance": round(distance, 4)}
+             for name, distance in st.session_state['similar_models']],
+            use_container_width=True)
+    elif 'similar_models' in st.session_state:
+        st.write("No models found")
+
+
+@st.cache_resource(show_spinner=False)
+def model_name_index(index_name):
+    '''
+    Local index of the model names (model_list.txt), used if the cluster can't answer the type-ahead
+    '''
+    import load_func as lf
+    list_path = os.path.join(os.path.dirname(csv_path), "model_list.txt")
+    if os.path.exists(list_path):
+        return lf.ModelNameIndex.from_file(list_path)
+    return lf.ModelNameIndex.from_index(get_client(), index_name)
+
+
+@st.fragment
+def find_model_panel(selected_index):
+    '''
+    Find a model from a part of its name, and show it in the list
+    '''
+    import load_func as lf
+
+    st.write('''Type the start of a model name, or of any part of it (e.g. :grey-background[a_30.0_e_0.3]),
+             and press Enter to see the matching models. Close matches are shown if there are no exact ones.''')
+    text = st.text_input("Model name", key="find_model")
+    if not text:
+        return
+    names = lf.suggest_models(get_client(), selected_index, text, size=20,
+                              local_index=lambda: model_name_index(selected_index))
+    if not names:
+        st.write("No models found")
+        return
+    name = st.selectbox("Matching models", names, key="found_model")
+    if st.button("Show in the list"):
+        st.session_state['search_request'] = {"query": {"term": {"Model name": name}}, "sort": None}
+        st.session_state['list_page'] = 0
+        st.session_state["display"] = True
+        st.rerun()
+
+
+@st.cache_data
+def field_details(csv_path) -> list:
+    '''
+    Descriptions of the fields of metadata.csv, displayed in the search tab
+    '''
+    details = []
+    with open(csv_path, "r") as csvfile:
+        for lines in csvfile:
+            if lines.startswith("#") or lines.startswith("0"):
+                continue
+            cell1, cell2 = lines.strip().split(",#,")
+            line = cell1.split(",")
+            string = f"- :orange[{line[0]}:]"
+            # type, format, units and file, the indexing profile is not displayed
+            for s in line[1:5]:
+                if s != "0":
+                    string+=f" {s},"
+            string = string.strip(",")
+            if cell2 != "0":
+                string+= "\n\n" +f"   {cell2.strip('"')}"
+            details.append(string.strip(","))
+    return details
+
 
-with search:
+@st.fragment
+def search_tab(selected_index, field_values):
     st.header("Search")
     st.write('''If you need to make a specific query that goes beyond what the sidebar on the left offers, 
              you can add your own query using the search bar below. Your results can then be dispayed in the "List" tab.''')
@@ -157,7 +417,7 @@ with search:
 
     st.markdown("---")
     # search bar
-    manual_query = st.text_input("Query", key="manual_query")
+    st.text_input("Query", key="manual_query")
     # add details on the query syntax
     st.write('''The search bar is for queries on numeric variables, and should be made with the following syntax:  
              - The field name followed by a colon, then the value you are looking for.   
@@ -174,21 +434,31 @@ with search:
     st.write("For queries on keyword fields, please use the selectors below.")
     with st.popover("Keyword filters"):
         # Version selector
-        versions = db.get_field_values(selected_index, client, "version")
-        version = st.multiselect("Phantom versions",
-            versions,versions,key='version')
+        versions = field_values["version"]
+        st.multiselect("Phantom versions",
+            versions,key='version')
         def _select_all():
             st.session_state.version = versions
         st.button("Select all Phantom versions", on_click=_select_all)
 
         # Publication selector
-        publications = db.get_field_values(selected_index, client, "Publication")
-        publication = st.multiselect("Publications",
-            publications,publications,key='publication')
+        publications = field_values["Publication"]
+        st.multiselect("Publications",
+            publications,key='publication')
         def _select_all():
             st.session_state.publication = publications
         st.button("Select both published and non-published work", on_click=_select_all)
 
+    from streamlit_js_eval import streamlit_js_eval
+    # page length (used for column placements)
+    page_width = streamlit_js_eval(
+        js_expressions='window.innerWidth',
+        key='WIDTH',
+        want_output=True,
+    )
+    if not page_width:
+        page_width = 800  # default page width value to prevent complaining about Nonetype
+
     col1_, col2_, col3_ = st.columns((2*page_width/6, page_width/6,  2*page_width/6))
     with col1_:
         pass
@@ -196,30 +466,25 @@ with search:
         pass
     with col2_:
         if st.button("Search", type='primary'):
-            st.session_state['search_results'] = db.fetch_data(
-                selected_index,  client, manual_query, eccentricity, massratio, sma, period,
-                icompanion, publication)
+            apply_query()
+
+    st.markdown("---")
+    st.markdown("### Find a model")
+    find_model_panel(selected_index)
+
+    st.markdown("---")
+    st.markdown("### Find similar models")
+    similar_models_panel(selected_index)
 
     st.markdown("---")
     st.markdown("### Field details")
     st.write("Here are the field name, the type of field (int, float, etc.), its format, units, and the file it is obtained from, if applicable.")
-    with open(csv_path, "r") as csvfile:
-        for lines in csvfile:
-            if lines.startswith("#") or lines.startswith("0"):
-                continue
-            cell1, cell2 = lines.strip().split(",#,")
-            line = cell1.split(",")
-            string = f"- :orange[{line[0]}:]"
-            for s in line[1:]:
-                if s != "0":
-                    string+=f" {s},"
-            string = string.strip(",")
-            if cell2 != "0":
-                string+= "\n\n" +f"   {cell2.strip('"')}"
-            st.write(string.strip(","))
+    for string in field_details(csv_path):
+        st.write(string)
 
 
-with list:
+@st.fragment
+def list_tab(selected_index, client):
     st.header("List of models")
     st.write("Here is a list of the models you queried. To prevent performance issues, the list is " \
              + "hidden by default. You can display/hide the list by using the buttons below.")
@@ -245,25 +510,62 @@ with list:
             st.session_state["display"] = False
     with col4_:
         pass
-    # display model list if the box is checked
+    # download the input files of all the models of the query in a single archive.
+    # The archive is built while it is downloaded, and streamed chunk by chunk (see app.py)
+    with st.popover("Download selection"):
+        include_images = st.checkbox("Include snapshots", key="bundle_images")
+        include_ev = st.checkbox("Include .ev files", key="bundle_ev")
+        st.caption("The files of each model are under its full folder path in the archive.")
+        if db.BUNDLE_ROUTE is None:
+            st.write("Downloading a selection needs the download route, start the dashboard with "
+                     + ":grey-background[streamlit run dashboard/app.py]")
+        elif st.button("Create download link"):
+            request = dict(st.session_state['search_request'])
+            token = db.register_bundle(
+                # errors stop the download, rather than sending a partial archive
+                lambda: (doc for page in db.fetch_pages(selected_index, client,
+                                                        fields=["Model name", "path to folder"],
+                                                        **request) for doc in page),
+                include_images=include_images,
+                include_ev=include_ev)
+            st.link_button("Download archive", f"{db.BUNDLE_ROUTE}/{token}")
+
+    # display model list if the box is checked, one page at a time
     if st.session_state['display']:
-        db.update_results(st.session_state['search_results'])
-
-# search button in the sidebar
-col1_, col2_, col3_ = st.sidebar.columns([1, 1, 1])
-with col1_:
-    pass
-with col2_:
-    if col2_.button("Apply"):
-        st.session_state['search_results'] = db.fetch_data(
-            selected_index, client, manual_query, eccentricity, massratio, sma, period,
-            icompanion, publication)
-        st.session_state["display"] = True
-        # unchecked the display box
-with col3_:
-    pass
+        n_results = db.count_hits(selected_index, client,
+                                  st.session_state['search_request']['query'])
+        col1_, col2_, col3_, col4_ = st.columns([1, 1, 1, 1])
+        with col1_:
+            page_size = st.selectbox("Models per page", [5, 10, 20, 50],
+                                     key="page_size")
+        n_pages = max(1, -(-n_results // page_size))
+        # the page can be out of range after a new query or page size
+        st.session_state['list_page'] = min(st.session_state['list_page'],
+                                            n_pages - 1)
+
+        def _change_page(step):
+            st.session_state['list_page'] += step
+
+        with col2_:
+            st.button("Previous page", on_click=_change_page, args=(-1,),
+                      disabled=st.session_state['list_page'] == 0)
+        with col3_:
+            st.button("Next page", on_click=_change_page, args=(1,),
+                      disabled=st.session_state['list_page'] >= n_pages - 1)
+        with col4_:
+            st.write(f"Page {st.session_state['list_page'] + 1} of {n_pages}")
+
+        db.update_results(
+            db.fetch_page(selected_index, client, st.session_state['list_page'],
+                          page_size, fields=db.LIST_FIELDS,
+                          **st.session_state['search_request']))
+
+@st.fragment
+def plots_tab(selected_index):
+    import altair as alt
+
+    alt.themes.enable("dark")
 
-with plots:
     st.header("Plots")
     st.write("Here are some useful plots to explore the parameter space of our dataset." \
              + " The data shown here is affected by the ranges and filters selected in the sidebar.")
@@ -275,172 +577,341 @@ with plots:
              + " You can also save the plot as a png file by clicking on the camera icon (📷) in the interface, and "\
              + "you can display the plot in full screen by clicking on the square icon.")
 
-    # Get data
-    d = {label: [] for label in dlabels.values()}
-    # get data from search results
-    for result in st.session_state['search_results']:
-        for key, value in dlabels.items():
-            if key in result.keys():
-                if key == "icompanion_star":
-                    d[value].append(str(result[key]))
-                else:
-                    d[value].append(result[key])
-            else:
-                d[value].append(None)
-    # build dataframe
-    data = pd.DataFrame(d)
+    # the data and figures are memoized for each query, so coming back to this tab is free
+    request_key = json.dumps(st.session_state['search_request'], sort_keys=True)
+    data = cached_data(plot_data, selected_index, request_key)
+    if data is None:
+        return
+
+    # large queries are binned by default, to keep the plots light for the browser
+    density = st.toggle(
+        "Density mode",
+        value=len(data) > db.LARGE_PLOT_THRESHOLD,
+        help="Group the models in bins, the size of each point shows the number of models in the bin.")
+    figs = cached_data(parameter_figures, selected_index, request_key, density)
+    if figs is None:
+        return
 
     # 3D scatter plots
     st.write("### Binary parameters")
     col1_, col2_ = st.columns(2)
     with col1_:
-        fig = px.scatter_3d(
+        st.plotly_chart(figs[0])
+    with col2_:
+        st.plotly_chart(figs[1])
+
+    # 2D scatter plots
+    st.write("### Wind properties")
+    col1_, col2_ = st.columns(2)
+    with col1_:
+        st.plotly_chart(figs[2])
+
+    # circle plots
+    st.write("### Model counts")
+    col1_, col2_ = st.columns(2)
+    figs = cached_data(count_figures, selected_index, request_key)
+    if figs == []:
+        st.write("No data to display")
+    elif figs:
+        with col1_:
+            st.plotly_chart(figs[0])
+            st.plotly_chart(figs[1])
+        with col2_:
+            st.plotly_chart(figs[2])
+            st.plotly_chart(figs[3])
+
+    # coverage of the parameter space, for all the models of the database
+    st.write("### Parameter space coverage")
+    coverage_panel(selected_index)
+
+
+@st.cache_resource(ttl=300, show_spinner=False)
+def coverage_grid(index_name):
+    '''
+    Coverage of the parameter space, from the file updated at each upload if it exists
+    '''
+    import load_func as lf
+
+    coverage_path = os.path.join(os.path.dirname(csv_path), "coverage.json")
+    if os.path.isfile(coverage_path):
+        return lf.CoverageGrid.load(coverage_path)
+    return lf.CoverageGrid.from_index(get_client(), index_name)
+
+
+def coverage_panel(selected_index):
+    '''
+    Number of models in each cell of the parameter grid, to find the regions without models
+    '''
+    import numpy as np
+    import plotly.express as px
+
+    grid = coverage_grid(selected_index)
+    fields = list(grid.fields)
+
+    st.write('''Number of models in each cell of a grid over the parameters below (models of the whole database).
+             Empty cells are regions of the parameter space that have not been explored yet.''')
+    col1_, col2_ = st.columns(2)
+    with col1_:
+        x = st.selectbox("x axis", fields, index=0, key="coverage_x")
+    with col2_:
+        y = st.selectbox("y axis", fields, index=1, key="coverage_y")
+
+    if x != y:
+        # number of models in each cell, summed over the other parameters
+        counts = np.zeros((grid.fields[y][2], grid.fields[x][2]), dtype=int)
+        for (i, j), count in grid.project([x, y]).items():
+            counts[j, i] = count
+        x_edges, y_edges = grid.bin_edges(x), grid.bin_edges(y)
+        fig = px.imshow(
+            counts,
+            x=[f"{lo:.3g}-{hi:.3g}" for lo, hi in zip(x_edges[:-1], x_edges[1:])],
+            y=[f"{lo:.3g}-{hi:.3g}" for lo, hi in zip(y_edges[:-1], y_edges[1:])],
+            labels={"x": x, "y": y, "color": "Model count"},
+            origin="lower",
+            text_auto=True,
+            color_continuous_scale='Turbo',
+        )
+        st.plotly_chart(fig)
+
+    # cells of the full grid with few models
+    max_count = st.number_input("Maximum number of models in a cell", 0, 100, 0,
+                                key="coverage_max_count")
+    sparse = grid.sparse_cells(max_count, limit=200)
+    st.write(f"{grid.count_sparse(max_count)} cells out of {grid.size()} "
+             + f"contain at most {max_count} model(s). The first 200 (fewest models first) are listed below.")
+    st.dataframe(
+        [{field: f"{lo:.3g} - {hi:.3g}" for field, (lo, hi) in grid.describe_cell(cell).items()}
+         | {"Model count": grid.count(cell)} for cell in sparse[:200]],
+        use_container_width=True)
+
+
+class SourceChanged(Exception):
+    '''
+    The client switched between the cluster and the snapshot while data was fetched
+    '''
+
+
+def check_source(offline):
+    '''
+    Raise SourceChanged if the data was not fetched from the source expected by the cached function
+    '''
+    if getattr(get_client(), "offline", False) != offline:
+        raise SourceChanged()
+
+
+def cached_data(function, *args):
+    '''
+    Call a cached function fetching data (plot_data, parameter_figures, count_figures).
+    Whether the data comes from the snapshot is part of the cache key, so it is fetched again from
+    the cluster when it is back. Errors are raised in the cached functions, so they are not cached,
+    and displayed here.
+    Returns:
+        the result of the function, None if it failed
+    '''
+    # the source can change once during the call (the cluster fails), then the snapshot is used
+    for _ in range(2):
+        try:
+            return function(*args, offline=getattr(get_client(), "offline", False))
+        except SourceChanged:
+            continue
+        except Exception as e:
+            st.error(f"Error fetching data from Elasticsearch: {e}")
+            return None
+    return None
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def plot_data(index_name, request_key, offline=False):
+    '''
+    Data of the plots for a query (request_key is the json of the search request)
+    offline: True if the data is expected from the snapshot (see cached_data)
+    '''
+    # Get data, typed with the field types of metadata.csv
+    data = db.fetch_frame(index_name, get_client(), db.PLOT_FIELDS,
+                          labels=dlabels,
+                          field_types=db.read_field_types(csv_path),
+                          raise_errors=True,
+                          **json.loads(request_key))
+    check_source(offline)
+    # the number of companions is used as a category for the colors
+    data["Number of companions"] = data["Number of companions"].astype("string")
+    return data
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def parameter_figures(index_name, request_key, density, offline=False):
+    '''
+    Figures of the binary parameters and wind properties for a query
+    '''
+    data = plot_data(index_name, request_key, offline=offline)
+    return [
+        db.parameter_scatter(
             data,
             x="Eccentricity",
             y="Mass ratio",
             z="Semi-major axis (AU)",
             color="Number of companions",
-            hover_data=["Model name"],
             title="Mass ratio vs. Eccentricity axis vs. Semi-major axis",
-            color_discrete_sequence=px.colors.qualitative.Safe,
-            opacity=0.7,
-        )
-        st.plotly_chart(fig)
-
-    with col2_:
-        fig = px.scatter_3d(
+            density=density,
+        ),
+        db.parameter_scatter(
             data,
             x="Eccentricity",
             y="Mass ratio",
             z="Orbital period (yr)",
             color="Number of companions",
-            hover_data=["Model name"],
             title="Mass ratio vs. Eccentricity axis vs. Orbital period",
-            color_discrete_sequence=px.colors.qualitative.Safe,
-            opacity=0.7,
-        )
-        st.plotly_chart(fig)
-
-    # 2D scatter plots
-    st.write("### Wind properties")
-    col1_, col2_ = st.columns(2)
-    with col1_:
-        fig = px.scatter(
+            density=density,
+        ),
+        db.parameter_scatter(
             data,
             x="Wind terminal velocity (km/s)",
             y="Mass loss rate (M_sun/yr)",
             color="Number of companions",
-            hover_data=["Model name"],
             title="Wind terminal velocity vs. Wind mass loss rate",
-            color_discrete_sequence=px.colors.qualitative.Safe,
-            opacity=0.7,
-        )
-        st.plotly_chart(fig)
-
-    # circle plots
-    st.write("### Model counts")
-    col1_, col2_ = st.columns(2)
-    count_df = data.groupby(["Eccentricity", "Mass ratio"
-                             ])["Model name"].count().reset_index()
+            density=density,
+        ),
+    ]
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def count_figures(index_name, request_key, offline=False):
+    '''
+    Figures of the model counts for a query, empty if there are no models
+    '''
+    import numpy as np
+    import plotly.express as px
+
+    client = get_client()
+    # counts are computed by Elasticsearch, only the count tables are sent back
+    count_query = json.loads(request_key)['query']
+    figs = []
+
+    # Eccentricity vs Mass ratio
+    count_df = db.get_counts(index_name, client,
+                             ["eccentricity", "mass_ratio"],
+                             query=count_query, labels=dlabels, raise_errors=True)
     if count_df.empty:
-        st.write("No data to display")
-    else:
-        with col1_:
-            # Eccentricity vs Mass ratio
-            count_df.rename(columns={"Model name": "Model count"},
-                            inplace=True)
-            # make scatter plot
-            fig = db.scatterplot(count_df,
-                                 x="Eccentricity",
-                                 y="Mass ratio",
-                                 size="Model count",
-                                 color="Model count",
-                                 hover_name="Model count",
-                                 opacity=0.7,
-                                 color_continuous_scale='Turbo')
-            st.plotly_chart(fig)
-
-            # Semi-major axis vs Mass ratio
-            count_df = data.groupby(["Semi-major axis (AU)", "Mass ratio"
-                                     ])["Model name"].count().reset_index()
-            count_df.rename(columns={"Model name": "Model count"},
-                            inplace=True)
-            # make scatter plot
-            fig = db.scatterplot(count_df,
-                                 x="Semi-major axis (AU)",
-                                 y="Mass ratio",
-                                 size="Model count",
-                                 color="Model count",
-                                 hover_name="Model count",
-                                 opacity=0.7,
-                                 color_continuous_scale='Turbo')
-            st.plotly_chart(fig)
-
-        with col2_:
-            # Eccentricity vs Semi-major axis
-            count_df = data.groupby(["Eccentricity", "Semi-major axis (AU)"
-                                     ])["Model name"].count().reset_index()
-            count_df.rename(columns={"Model name": "Model count"},
-                            inplace=True)
-
-            # make scatter plot
-            fig = db.scatterplot(count_df,
-                                 x="Eccentricity",
-                                 y="Semi-major axis (AU)",
-                                 size="Model count",
-                                 color="Model count",
-                                 hover_name="Model count",
-                                 opacity=0.7,
-                                 color_continuous_scale='Turbo')
-            st.plotly_chart(fig)
-
-            # make 3d scatter plot
-            count_df = data.groupby(
-                ["Eccentricity", "Mass ratio",
-                 "Semi-major axis (AU)"])["Model name"].count().reset_index()
-            count_df.rename(columns={"Model name": "Model count"},
-                            inplace=True)
-            count_df["bubble size"] = (np.sqrt(count_df['Model count']))
-            sizeref = 2. * max(count_df['bubble size']) / (1000)
-
-            fig = px.scatter_3d(
-                count_df,
-                x="Eccentricity",
-                y="Semi-major axis (AU)",
-                z="Mass ratio",
-                size="bubble size",
-                color="Model count",
-                title="Eccentricity vs. Semi-major axis vs. Mass ratio",
-                color_continuous_scale='Turbo',
-                opacity=0.7,
-            )
-            fig.update_traces(marker=dict(line=dict(width=20, color='white')),
-                              selector=dict(mode='markers'))
-            fig.update_layout(scene=dict(
-                xaxis=dict(
-                    backgroundcolor="#cfe2f3",
-                    gridcolor="white",
-                    showbackground=True,
-                    zerolinecolor="white",
-                ),
-                yaxis=dict(backgroundcolor="#cfe2f3",
-                           gridcolor="white",
-                           showbackground=True,
-                           zerolinecolor="white"),
-                zaxis=dict(
-                    backgroundcolor="#cfe2f3",
-                    gridcolor="white",
-                    showbackground=True,
-                    zerolinecolor="white",
-                ),
-            ), )
-            fig.update_traces(mode='markers',
-                              marker=dict(sizemode='area',
-                                          sizeref=sizeref,
-                                          line_width=2))
-            st.plotly_chart(fig)
-
+        check_source(offline)
+        return []
+    # make scatter plot
+    figs.append(db.scatterplot(count_df,
+                               x="Eccentricity",
+                               y="Mass ratio",
+                               size="Model count",
+                               color="Model count",
+                               hover_name="Model count",
+                               opacity=0.7,
+                               color_continuous_scale='Turbo'))
+
+    # Semi-major axis vs Mass ratio
+    count_df = db.get_counts(index_name, client,
+                             ["semi_major_axis", "mass_ratio"],
+                             query=count_query, labels=dlabels, raise_errors=True)
+    # make scatter plot
+    figs.append(db.scatterplot(count_df,
+                               x="Semi-major axis (AU)",
+                               y="Mass ratio",
+                               size="Model count",
+                               color="Model count",
+                               hover_name="Model count",
+                               opacity=0.7,
+                               color_continuous_scale='Turbo'))
+
+    # Eccentricity vs Semi-major axis
+    count_df = db.get_counts(index_name, client,
+                             ["eccentricity", "semi_major_axis"],
+                             query=count_query, labels=dlabels, raise_errors=True)
+    # make scatter plot
+    figs.append(db.scatterplot(count_df,
+                               x="Eccentricity",
+                               y="Semi-major axis (AU)",
+                               size="Model count",
+                               color="Model count",
+                               hover_name="Model count",
+                               opacity=0.7,
+                               color_continuous_scale='Turbo'))
+
+    # make 3d scatter plot
+    count_df = db.get_counts(
+        index_name, client,
+        ["eccentricity", "mass_ratio", "semi_major_axis"],
+        query=count_query, labels=dlabels, raise_errors=True)
+    check_source(offline)
+    count_df["bubble size"] = (np.sqrt(count_df['Model count']))
+    sizeref = 2. * max(count_df['bubble size']) / (1000)
+
+    fig = px.scatter_3d(
+        count_df,
+        x="Eccentricity",
+        y="Semi-major axis (AU)",
+        z="Mass ratio",
+        size="bubble size",
+        color="Model count",
+        title="Eccentricity vs. Semi-major axis vs. Mass ratio",
+        color_continuous_scale='Turbo',
+        opacity=0.7,
+    )
+    fig.update_traces(marker=dict(line=dict(width=20, color='white')),
+                      selector=dict(mode='markers'))
+    fig.update_layout(scene=dict(
+        xaxis=dict(
+            backgroundcolor="#cfe2f3",
+            gridcolor="white",
+            showbackground=True,
+            zerolinecolor="white",
+        ),
+        yaxis=dict(backgroundcolor="#cfe2f3",
+                   gridcolor="white",
+                   showbackground=True,
+                   zerolinecolor="white"),
+        zaxis=dict(
+            backgroundcolor="#cfe2f3",
+            gridcolor="white",
+            showbackground=True,
+            zerolinecolor="white",
+        ),
+    ), )
+    fig.update_traces(mode='markers',
+                      marker=dict(sizemode='area',
+                                  sizeref=sizeref,
+                                  line_width=2))
+    figs.append(fig)
+
+    return figs
+
+
+with filters:
+    sidebar_filters(field_values, ranges)
+if view == "Search":
+    search_tab(selected_index, field_values)
+elif view == "List":
+    list_tab(selected_index, client)
+elif view == "Plots":
+    plots_tab(selected_index)
 
 # display query results
-st.sidebar.write(str(len(st.session_state['search_results'])) + " models found")
-st.write(str(len(st.session_state['search_results'])) + " models found")
+n_models = db.count_hits(selected_index, client, st.session_state['search_request']['query'])
+st.sidebar.write(str(n_models) + " models found")
+st.write(str(n_models) + " models found")
+
+# results from the snapshot may be out of date
+if getattr(client, "offline", False):
+    from datetime import datetime, timezone
+
+    age = datetime.now(timezone.utc) - client.snapshot.created
+    st.sidebar.warning(
+        "Elasticsearch is unavailable, showing the snapshot of "
+        + f"{client.snapshot.created:%Y-%m-%d %H:%M} UTC ({age.days} days, "
+        + f"{age.seconds // 3600} hours old). Free-text searches are not available.")
+
+# file cache usage, shared by all users of the dashboard
+cache_stats = db.get_file_cache().stats()
+st.sidebar.caption(
+    f"File cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+    + f"{cache_stats['bytes'] / 1024**2:.1f}/{cache_stats['max_bytes'] / 1024**2:.0f} MB")
+
+# loading times
+st.sidebar.caption(
+    f"First paint: {first_paint * 1000:.0f} ms, "
+    + f"full page: {(time.perf_counter() - start_time) * 1000:.0f} ms")
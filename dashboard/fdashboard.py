@@ -1,32 +1,201 @@
 " Functions used in dashboard.py "
 
+# sort used to display the most recent models first
+RECENT_SORT = [{"model date": {"order": "desc"}}]
 
-def fetch_recent_data(index_name, client, size=1000):
+# Fields fetched for each view (_source includes), None fetches the whole documents.
+# The list view displays every stored field in the "More details" expander.
+LIST_FIELDS = None
+# The plots only use these fields (see dlabels in dashboard.py)
+PLOT_FIELDS = [
+    "eccentricity",
+    "mass_ratio",
+    "semi_major_axis",
+    "period",
+    "icompanion_star",
+    "Model name",
+    "wind_mass_rate",
+    "wind_terminal_velocity",
+]
+
+
+def fetch_recent_data(index_name, client, size=1000, fields=None):
     """
     Fetch recent data from Elasticsearch using no extra filters
+    If size is None, all documents are returned
+    fields restricts the returned fields (e.g. PLOT_FIELDS), all fields are returned if None
     """
-    from elasticsearch import Elasticsearch
     import streamlit as st
     try:
-        query_body = {
-            "size": size,
-            "sort": [
-                {
-                    "model date": {
-                        "order": "desc"
-                    }
-                },  # Primary sort by date
-            ]
-        }
+        if size is not None and size <= 10000:
+            # a single request without counting the hits: on an index sorted by model date
+            # (see create_settings in load_func.py), each shard stops after the first size documents
+            body = {"size": size, "sort": RECENT_SORT, "track_total_hits": False}
+            if fields is not None:
+                body["_source"] = {"includes": list(fields)}
+            response = client.search(index=index_name, body=body)
+            return [hit['_source'] for hit in response['hits']['hits']]
 
-        response = client.search(index=index_name, body=query_body)
-        return [hit['_source'] for hit in response['hits']['hits']]
+        results = []
+        for page in fetch_pages(index_name, client, sort=RECENT_SORT,
+                                fields=fields):
+            results.extend(page)
+            if size is not None and len(results) >= size:
+                return results[:size]
+        return results
 
     except Exception as e:
         st.error(f"Error fetching recent data from Elasticsearch: {e}")
         return []
 
 
+def fetch_pages(index_name,
+                client,
+                query=None,
+                sort=None,
+                fields=None,
+                page_size=1000,
+                keep_alive="1m"):
+    '''
+    Generator yielding the results of a query page by page, as lists of documents.
+    Uses a point in time and search_after, so the number of results is not
+    limited by the 10000 hits window of a regular search, and only one page is held in memory.
+    Args:
+        query: query clause of the search (e.g. from build_query), all documents if None
+        sort: list of sort clauses, the index order is used if None (fastest)
+        fields: list of fields to return for each document, all fields if None
+        page_size: number of documents per page
+        keep_alive: how long the point in time is kept open between two pages
+    '''
+    for hits in _search_hits(index_name, client, query, sort, fields,
+                             page_size, keep_alive):
+        yield [hit['_source'] for hit in hits]
+
+
+def _search_hits(index_name, client, query, sort, fields, page_size,
+                 keep_alive):
+    '''
+    Generator yielding the raw hits of a query page by page (see fetch_pages).
+    If fields is False, the documents are not sent back (only ids and sort values).
+    '''
+    pit_id = client.open_point_in_time(index=index_name,
+                                       keep_alive=keep_alive)['id']
+    try:
+        search_after = None
+        while True:
+            body = {
+                "size": page_size,
+                "query": query or {"match_all": {}},
+                "pit": {"id": pit_id, "keep_alive": keep_alive},
+                # _shard_doc is the cheapest tiebreaker available with a point in time
+                "sort": list(sort or []) + [{"_shard_doc": "asc"}],
+            }
+            if fields is False:
+                body["_source"] = False
+            elif fields is not None:
+                # only send back the fields we need, reduces the payload and decoding time
+                body["_source"] = {"includes": list(fields)}
+            if search_after is not None:
+                body["search_after"] = search_after
+
+            response = client.search(body=body)
+            hits = response['hits']['hits']
+            if not hits:
+                break
+            # the point in time id can change between requests
+            if 'pit_id' in response:
+                pit_id = response['pit_id']
+            search_after = hits[-1]['sort']
+
+            yield hits
+
+            if len(hits) < page_size:
+                break
+    finally:
+        try:
+            client.close_point_in_time(id=pit_id)
+        except Exception:
+            # the point in time expires on its own after keep_alive
+            pass
+
+
+# number of ids read per request when walking to a deep page (see fetch_page)
+DEEP_PAGE_STEP = 10000
+
+
+def fetch_page(index_name,
+               client,
+               page,
+               page_size=20,
+               query=None,
+               sort=None,
+               fields=None,
+               max_window=10000,
+               step=DEEP_PAGE_STEP):
+    '''
+    Fetch a single page of results (pages start at 0), e.g. for the list view.
+    Pages within the first max_window hits (index.max_result_window) use from/size,
+    deeper pages are reached by walking the ids with search_after, step hits per request
+    (at most max_window, at least page_size), and then fetched by id.
+    '''
+    import streamlit as st
+
+    start = page * page_size
+    try:
+        if start + page_size <= max_window:
+            sort = list(sort or [])
+            body = {
+                "from": start,
+                "size": page_size,
+                "query": query or {"match_all": {}},
+                # same order as the deep pages (_shard_doc is the _doc order on our single shard).
+                # Sorted on the index sort (see create_settings in load_func.py), the ties are
+                # already in _doc order, and without a tiebreaker nor a total hit count the shard
+                # stops after the first documents (counts come from count_hits)
+                "sort": sort if sort == RECENT_SORT else sort + ["_doc"],
+                "track_total_hits": False,
+            }
+            if fields is not None:
+                body["_source"] = {"includes": list(fields)}
+            response = client.search(index=index_name, body=body)
+            return [hit['_source'] for hit in response['hits']['hits']]
+
+        # skip the previous hits without sending back the documents, the page can
+        # overlap two steps
+        ids = []
+        skipped = 0
+        for hits in _search_hits(index_name, client, query, sort, False,
+                                 max(min(step, max_window), page_size), "1m"):
+            if skipped + len(hits) > start:
+                ids += [hit['_id'] for hit in
+                        hits[max(start - skipped, 0):start + page_size - skipped]]
+                if len(ids) == page_size:
+                    break
+            skipped += len(hits)
+        if not ids:
+            return []
+        kwargs = {"_source_includes": list(fields)} if fields is not None else {}
+        response = client.mget(index=index_name, body={"ids": ids}, **kwargs)
+        return [doc['_source'] for doc in response['docs'] if doc.get('found')]
+
+    except Exception as e:
+        st.error(f"Error fetching data from Elasticsearch: {e}")
+        return []
+
+
+def count_hits(index_name, client, query=None) -> int:
+    '''
+    Count the number of documents matching a query, without fetching them
+    '''
+    import streamlit as st
+    try:
+        body = {"query": query or {"match_all": {}}}
+        return client.count(index=index_name, body=body)['count']
+    except Exception as e:
+        st.error(f"Error counting documents in Elasticsearch: {e}")
+        return 0
+
+
 def get_field_values(index_name, client, field):
     '''
     Get all unique values for a field in the index
@@ -46,32 +215,334 @@ def get_range(index_name, client, field) -> tuple:
     '''
     Get the minimum and maximum values for a field in the index
     '''
-    from elasticsearch import Elasticsearch
+    aggregation = {
+        "max_val": {"max": {"field": field}},
+        "min_val": {"min": {"field": field}}
+    }
 
-    max_aggregation = {"max_val": {"max": {"field": field}}}
+    # both values in a single request
+    result = client.search(index=index_name,
+                           body={"size": 0, "aggs": aggregation})
 
-    min_aggregation = {"min_val": {"min": {"field": field}}}
+    max = result['aggregations']['max_val']['value']
+    min = result['aggregations']['min_val']['value']
 
-    max_result = client.search(index=index_name,
-                               body={"aggs": max_aggregation})
-    min_result = client.search(index=index_name,
-                               body={"aggs": min_aggregation})
+    return min, max
 
-    max = max_result['aggregations']['max_val']['value']
-    min = min_result['aggregations']['min_val']['value']
 
-    return min, max
+def get_filters(index_name, client, value_fields, range_fields) -> tuple:
+    '''
+    Get the unique values of some fields and the ranges of others, with concurrent requests
+    Returns:
+        dictionary {field: values} and dictionary {field: (min, max)}
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(
+            max_workers=len(value_fields) + len(range_fields)) as pool:
+        values = {
+            field: pool.submit(get_field_values, index_name, client, field)
+            for field in value_fields
+        }
+        ranges = {
+            field: pool.submit(get_range, index_name, client, field)
+            for field in range_fields
+        }
+        return ({field: future.result() for field, future in values.items()},
+                {field: future.result() for field, future in ranges.items()})
+
+
+def get_counts(index_name, client, fields, query=None, labels=None, raise_errors=False):
+    '''
+    Count the models for each combination of values of the given fields, using a
+    composite aggregation so the counting is done by Elasticsearch.
+    Documents missing one of the fields are not counted.
+    Args:
+        fields: list of fields to group the models by
+        query: query clause restricting the models counted, all models if None
+        labels: optional dictionary {field: column name} used to name the columns
+        raise_errors: raise the errors instead of returning the counts found so far
+    Returns:
+        pandas DataFrame with one column per field and a "Model count" column
+    '''
+    import pandas as pd
+    import streamlit as st
+
+    labels = labels or {}
+    columns = [labels.get(field, field) for field in fields]
+    rows = []
+    try:
+        composite = {
+            "size": 1000,
+            "sources": [{field: {"terms": {"field": field}}} for field in fields]
+        }
+        while True:
+            body = {
+                "size": 0,
+                "query": query or {"match_all": {}},
+                "aggs": {"counts": {"composite": composite}}
+            }
+            response = client.search(index=index_name, body=body)
+            counts = response['aggregations']['counts']
+            for bucket in counts['buckets']:
+                # float fields are stored in single precision, round to drop the conversion noise
+                rows.append([
+                    float(f"{bucket['key'][field]:.6g}")
+                    if isinstance(bucket['key'][field], float) else
+                    bucket['key'][field] for field in fields
+                ] + [bucket['doc_count']])
+            if 'after_key' not in counts or not counts['buckets']:
+                break
+            composite["after"] = counts['after_key']
+
+    except Exception as e:
+        if raise_errors:
+            raise
+        st.error(f"Error counting models in Elasticsearch: {e}")
+
+    return pd.DataFrame(rows, columns=columns + ["Model count"])
+
+
+class FileCache:
+    '''
+    Least recently used cache of file contents, with a maximum total size in bytes.
+    Entries are keyed by path and modification time, so a modified file is read again.
+    '''
+
+    def __init__(self, max_bytes):
+        from collections import OrderedDict
+        from threading import Lock
+
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # the cache is shared by all the sessions of the dashboard, which run in different threads
+        self._lock = Lock()
+
+    def read(self, path) -> bytes:
+        '''
+        Return the content of a file, from memory if possible.
+        Raises OSError if the file can't be read.
+        '''
+        import os
+
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        with self._lock:
+            # files larger than the budget are not kept
+            if len(data) <= self.max_bytes and key not in self._entries:
+                self._entries[key] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, old = self._entries.popitem(last=False)
+                    self.size -= len(old)
+        return data
+
+    def stats(self) -> dict:
+        '''
+        Return the number of hits, misses, entries and bytes used
+        '''
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes
+            }
+
+
+# one cache per process, shared by all sessions (modules are only imported once by streamlit)
+_file_cache = None
+
+
+def get_file_cache() -> FileCache:
+    '''
+    Get the cache used for the model images and input files.
+    Its size in MB is set with the FILE_CACHE_MB environment variable (default 256 MB).
+    '''
+    import os
+    global _file_cache
+    if _file_cache is None:
+        _file_cache = FileCache(
+            int(float(os.getenv('FILE_CACHE_MB', 256)) * 1024**2))
+    return _file_cache
+
+
+def read_cached_file(path) -> bytes:
+    '''
+    Read a file through the shared file cache
+    '''
+    return get_file_cache().read(path)
+
+
+# files added to the download bundle for each model
+BUNDLE_INPUT_FILES = ["wind.in", "wind.setup"]
+BUNDLE_IMAGE_FILES = ["orbital.png", "orbital_zoom.png"]
+
+
+# size of the chunks of the download bundle sent to the browser
+BUNDLE_CHUNK_SIZE = 1024**2
+
+
+class _GzipChunks:
+    '''
+    Gzip compression of a stream of bytes, handed out in chunks of a fixed size
+    '''
+
+    def __init__(self, chunk_size):
+        import zlib
+
+        self.chunk_size = chunk_size
+        # wbits=31 writes the gzip header and trailer
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.buffer = bytearray()
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        self.buffer += self.compressor.compress(data)
+
+    def chunks(self, final=False):
+        if final:
+            self.buffer += self.compressor.flush()
+        while len(self.buffer) >= self.chunk_size or (final and self.buffer):
+            chunk = bytes(self.buffer[:self.chunk_size])
+            del self.buffer[:self.chunk_size]
+            yield chunk
+
+
+def iter_bundle(models, include_images=False, include_ev=False, chunk_size=BUNDLE_CHUNK_SIZE):
+    '''
+    Generator yielding a tar.gz archive of the input files of several models, in chunks of chunk_size
+    bytes (the last one is smaller). The files are read and compressed block by block while the
+    archive is sent, so neither the archive nor a whole file is held in memory.
+    The files of a model are under its full "path to folder" in the archive, as model names are
+    not unique. The models loaded from archives (see ArchiveModels in load_func.py) are read from
+    them after the others, one pass per archive.
+    Args:
+        models: iterable of documents with the "Model name" and "path to folder" fields
+        include_images: also add the orbital snapshots
+        include_ev: also add the .ev files
+    Files that are missing for a model are skipped.
+    '''
+    import glob
+    import os
+    import posixpath
+    import tarfile
+
+    import load_func as lf
+
+    out = _GzipChunks(chunk_size)
+    names = list(BUNDLE_INPUT_FILES) + (BUNDLE_IMAGE_FILES if include_images else [])
+
+    def add(directory, file, size, mtime, f):
+        info = tarfile.TarInfo(posixpath.join(directory.replace(os.sep, "/").strip("/"), file))
+        info.size, info.mtime, info.mode = size, mtime, 0o644
+        out.write(info.tobuf(tarfile.DEFAULT_FORMAT))
+        remaining = info.size
+        while remaining > 0:
+            # a file truncated while it is read is padded, the header has its size
+            block = f.read(min(chunk_size, remaining)) or bytes(remaining)
+            out.write(block)
+            remaining -= len(block)
+            yield from out.chunks()
+        # the content of each member fills whole blocks
+        out.write(bytes(-info.size % tarfile.BLOCKSIZE))
+
+    # {archive: {directory of the model in the archive: path to folder}}
+    archived = {}
+    for model in models:
+        directory = model['path to folder']
+        archive, member = lf.split_archive_path(directory)
+        if archive is not None:
+            archived.setdefault(archive, {})[member] = directory
+            continue
+        files = list(names)
+        if include_ev:
+            files += sorted(glob.glob("*.ev", root_dir=directory))
+        for file in files:
+            path = os.path.join(directory, file)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                yield from add(directory, file, stat.st_size, stat.st_mtime, f)
+    for archive, directories in archived.items():
+        for path, size, mtime, open_member in lf.archive_members(archive):
+            directory, file = posixpath.split(path.strip("/"))
+            if directory in directories and (file in names or include_ev and file.endswith(".ev")):
+                with open_member() as f:
+                    yield from add(directories[directory], file, size, mtime, f)
+    # end of archive: two empty blocks, padded to a whole record as tarfile does
+    out.write(bytes(2 * tarfile.BLOCKSIZE))
+    out.write(bytes(-out.written % tarfile.RECORDSIZE))
+    yield from out.chunks(final=True)
+
+
+# path of the route streaming the download bundles (see app.py), None if the dashboard
+# is not started with it
+BUNDLE_ROUTE = None
+# download links expire after this time in s
+BUNDLE_LINK_TTL = 3600
+_bundle_links = {}
+
+
+def register_bundle(models, include_images=False, include_ev=False) -> str:
+    '''
+    Register a download bundle, sent by the bundle route of app.py
+    Args:
+        models: function returning the iterable of models of the bundle (see iter_bundle),
+        called when the bundle is downloaded
+    Returns:
+        token of the download link, BUNDLE_ROUTE/<token>
+    '''
+    import secrets
+    import time
+
+    now = time.monotonic()
+    # forget the expired links
+    for token, (expiry, _) in list(_bundle_links.items()):
+        if expiry < now:
+            _bundle_links.pop(token, None)
+    token = secrets.token_urlsafe(16)
+    _bundle_links[token] = (now + BUNDLE_LINK_TTL, (models, include_images, include_ev))
+    return token
+
+
+def bundle_chunks(token):
+    '''
+    Chunks of the archive of a registered download link (see register_bundle), None if it expired
+    '''
+    import time
+
+    expiry, (models, include_images, include_ev) = _bundle_links.get(token, (0, (None, None, None)))
+    if expiry < time.monotonic():
+        return None
+    return iter_bundle(models(), include_images, include_ev)
 
 
 def update_results(results):
     '''
     Update the results of the search
+    Everything is rendered for each result, so only pass the models of the visible page (see fetch_page)
     '''
     import os
     import streamlit as st
     import streamlit_ext as ste
     try:
-        for result_item in results:
+        for position, result_item in enumerate(results):
             # Display document
             st.markdown(f"##### {result_item['Model name']}")
             # Details arranged in columns
@@ -134,8 +605,9 @@ def update_results(results):
                     unsafe_allow_html=True)
                 try:
                     st.image(
-                        os.path.join(result_item['path to folder'],
-                                     "orbital.png"))
+                        read_cached_file(
+                            os.path.join(result_item['path to folder'],
+                                         "orbital.png")))
                 except:
                     st.markdown(
                         f" <p align=center> snapshot not available </p>",
@@ -145,37 +617,44 @@ def update_results(results):
                             unsafe_allow_html=True)
                 try:
                     st.image(
-                        os.path.join(result_item['path to folder'],
-                                     "orbital_zoom.png"))
+                        read_cached_file(
+                            os.path.join(result_item['path to folder'],
+                                         "orbital_zoom.png")))
                 except:
                     st.markdown(f" <p align=center> not available </p>",
                                 unsafe_allow_html=True)
             col1_, col2_, col3_, col4_ = st.columns([1, 1, 1, 1])
             with col1_:
                 pass
-            with col2_:
-                with open(
-                        os.path.join(result_item['path to folder'], 'wind.in'),
-                        "rb") as f:
+            if os.path.isdir(result_item['path to folder']):
+                with col2_:
                     # regular dl buttons refresh the state of the page so we use streamlit_ext buttons
                     ste.download_button(
                         "Download .in file",
-                        data=f,
+                        data=read_cached_file(
+                            os.path.join(result_item['path to folder'],
+                                         'wind.in')),
                         file_name='wind.in',
                     )
-            with col3_:
-                with open(
-                        os.path.join(result_item['path to folder'],
-                                     'wind.setup'), "rb") as f:
+                with col3_:
                     ste.download_button(
                         "Download .setup file",
-                        data=f,
+                        data=read_cached_file(
+                            os.path.join(result_item['path to folder'],
+                                         'wind.setup')),
                         file_name='wind.setup',
                     )
+            else:
+                # models loaded from an archive (see ArchiveModels in load_func.py)
+                with col2_:
+                    st.caption("The files of this model are not on disk (stored in an archive).")
             with col4_:
                 pass
 
-            with st.expander("More details", icon='🔥'):
+            # the details are only written when the toggle is on
+            # model names are not unique, the position keeps the keys of the widgets unique
+            if st.toggle("🔥 More details",
+                         key=f"details_{position}_{result_item['path to folder']}"):
                 st.write(
                     'Here are all the model parameters stored in the database:'
                 )
@@ -192,6 +671,149 @@ def update_results(results):
         st.error(f"Error performing search in Elasticsearch: {e}")
 
 
+# pandas dtypes of the field types used in metadata.csv
+PANDAS_DTYPES = {
+    "float": "float64",
+    "integer": "Int64",  # nullable, models can miss a field
+    "keyword": "string",
+    "date": "datetime64[ns]",
+}
+
+
+def read_field_types(csv_path) -> dict:
+    '''
+    Read the type of each field from metadata.csv
+    Returns:
+        dictionary {field label: elasticsearch type}
+    '''
+    types = {}
+    with open(csv_path, "r") as csvfile:
+        for lines in csvfile:
+            if lines.startswith("#") or lines.startswith("0"):
+                continue
+            line = lines.strip().split(",#,")[0].split(",")
+            types[line[0]] = line[1]
+    return types
+
+
+def pages_to_frame(pages, fields, labels=None, field_types=None):
+    '''
+    Build a DataFrame from pages of documents (e.g. from fetch_pages), one column per field.
+    Each page is converted at once, and the columns are cast to the type of the field.
+    Args:
+        pages: iterable of lists of documents
+        fields: fields to put in the DataFrame, missing values are set to NA
+        labels: optional dictionary {field: column name} used to name the columns
+        field_types: optional dictionary {field: elasticsearch type} (see read_field_types)
+    '''
+    import pandas as pd
+
+    frames = [pd.DataFrame.from_records(page, columns=fields) for page in pages]
+    if frames:
+        data = pd.concat(frames, ignore_index=True)
+    else:
+        data = pd.DataFrame(columns=fields)
+
+    if field_types:
+        data = data.astype({
+            field: PANDAS_DTYPES[field_types[field]]
+            for field in fields
+            if field_types.get(field) in PANDAS_DTYPES
+        })
+    if labels:
+        data = data.rename(columns=labels)
+    return data
+
+
+def fetch_frame(index_name,
+                client,
+                fields,
+                query=None,
+                sort=None,
+                labels=None,
+                field_types=None,
+                raise_errors=False):
+    '''
+    Fetch the given fields of all documents matching a query as a DataFrame (see pages_to_frame)
+    If raise_errors, errors are raised instead of returning an empty DataFrame (e.g. not to cache it)
+    '''
+    import streamlit as st
+
+    try:
+        return pages_to_frame(
+            fetch_pages(index_name, client, query=query, sort=sort,
+                        fields=fields), fields, labels, field_types)
+    except Exception as e:
+        if raise_errors:
+            raise
+        st.error(f"Error fetching data from Elasticsearch: {e}")
+        return pages_to_frame([], fields, labels, field_types)
+
+
+def build_query(manual_query, eccentricity, massratio, sma, period,
+                icompanion, publication):
+    '''
+    Build the query clause from an optional search query, and ranges and filters applied
+    '''
+    query = {"bool": {"should": []}}
+    query["bool"]["must"] = []
+
+    # Add manual query if needed
+    if manual_query:
+        query["bool"]["must"].append(
+            {"query_string": {
+                "query": manual_query,
+                "default_field": "mass ratio"
+            }})
+
+    # Add binary ranges to query if needed
+    if icompanion:
+        if 0 not in icompanion:
+            query["bool"]["must"].append({
+                "range": {
+                    "eccentricity": {
+                        "gte": eccentricity[0],
+                        "lte": eccentricity[1]
+                    }
+                }})
+            query["bool"]["must"].append({
+                "range": {
+                    "mass_ratio": {
+                        "gte": massratio[0],
+                        "lte": massratio[1]
+                    }
+                }})
+            query["bool"]["must"].append({
+                "range": {
+                    "semi_major_axis": {
+                        "gte": sma[0],
+                        "lte": sma[1]
+                    }
+                }})
+            query["bool"]["must"].append({
+                "range": {
+                    "period": {
+                        "gte": period[0],
+                        "lte": period[1]
+                    }
+                }})
+
+    # add filters on number of companions
+    query["bool"]["filter"] = []
+    if icompanion:
+        query["bool"]["filter"].append(
+            {"terms": {
+                'icompanion_star': icompanion
+            }})
+    if publication:
+            query["bool"]["filter"].append(
+                {"terms": {
+                    'Publication': publication
+                }})
+
+    return query
+
+
 def fetch_data(index_name,
                client,
                manual_query,
@@ -201,80 +823,60 @@ def fetch_data(index_name,
                period,
                icompanion,
                publication,
-               size=10000):
+               size=None,
+               fields=None):
     '''
     Fetch data from Elasticsearch based on an optional search query, and ranges and filters applied
+    If size is None, all matching documents are returned
+    fields restricts the returned fields (e.g. PLOT_FIELDS), all fields are returned if None
     '''
 
     import streamlit as st
 
     try:
-        query_body = {"size": size, "query": {"bool": {"should": []}}}
-        query_body["query"]["bool"]["must"] = []
-
-        # Add manual query if needed
-        if manual_query:
-            query_body["query"]["bool"]["must"].append(
-                {"query_string": {
-                    "query": manual_query,
-                    "default_field": "mass ratio"
-                }})
-
-        # Add binary ranges to query if needed
-        if icompanion:
-            if 0 not in icompanion:
-                query_body["query"]["bool"]["must"].append({
-                    "range": {
-                        "eccentricity": {
-                            "gte": eccentricity[0],
-                            "lte": eccentricity[1]
-                        }
-                    }})
-                query_body["query"]["bool"]["must"].append({
-                    "range": {
-                        "mass_ratio": {
-                            "gte": massratio[0],
-                            "lte": massratio[1]
-                        }
-                    }})
-                query_body["query"]["bool"]["must"].append({
-                    "range": {
-                        "semi_major_axis": {
-                            "gte": sma[0],
-                            "lte": sma[1]
-                        }
-                    }})
-                query_body["query"]["bool"]["must"].append({
-                    "range": {
-                        "period": {
-                            "gte": period[0],
-                            "lte": period[1]
-                        }
-                    }})
-
-        # add filters on number of companions
-        query_body["query"]["bool"]["filter"] = []
-        if icompanion:
-            query_body["query"]["bool"]["filter"].append(
-                {"terms": {
-                    'icompanion_star': icompanion
-                }})
-        if publication:
-                query_body["query"]["bool"]["filter"].append(
-                    {"terms": {
-                        'Publication': publication
-                    }})
+        query = build_query(manual_query, eccentricity, massratio, sma, period,
+                            icompanion, publication)
 
         # Query
-        result = client.search(index=index_name, body=query_body)
-
-        return [hit['_source'] for hit in result['hits']['hits']]
+        results = []
+        for page in fetch_pages(index_name, client, query=query,
+                                fields=fields):
+            results.extend(page)
+            if size is not None and len(results) >= size:
+                return results[:size]
+        return results
 
     except Exception as e:
         st.error(f"Error fetching data from Elasticsearch: {e}")
         return []
 
 
+def iter_results(index_name,
+                 client,
+                 query=None,
+                 sort=None,
+                 fields=None,
+                 page_size=1000):
+    '''
+    Iterate lazily over the documents matching a query, fetching one page at a time.
+    Only the given fields are fetched if fields is not None.
+    Errors are displayed in the dashboard and stop the iteration.
+    '''
+    import streamlit as st
+
+    try:
+        for page in fetch_pages(index_name,
+                                client,
+                                query=query,
+                                sort=sort,
+                                fields=fields,
+                                page_size=page_size):
+            yield from page
+
+    except Exception as e:
+        st.error(f"Error fetching data from Elasticsearch: {e}")
+
+
 def scatterplot(data, x, y, size, color, hover_name, opacity,
                 color_continuous_scale):
     '''
@@ -313,6 +915,86 @@ def scatterplot(data, x, y, size, color, hover_name, opacity,
     return fig
 
 
+# number of models above which the plots are binned by default
+LARGE_PLOT_THRESHOLD = 5000
+
+
+def bin_points(data, columns, bins=30, by=None):
+    '''
+    Bin the models on a regular grid over the given columns (2D or 3D), using NumPy.
+    Only the non-empty bins are returned, so the size of the result is bounded by
+    the number of bins and not by the number of models.
+    Args:
+        data: DataFrame of models
+        columns: columns used for the grid
+        bins: number of bins along each column
+        by: optional column, the models are binned separately for each of its values
+    Returns:
+        DataFrame with the bin centers, the "Model count" of each bin, and the by column
+    '''
+    import numpy as np
+    import pandas as pd
+
+    data = data.dropna(subset=columns)
+    # same edges for every group, so the bins can be compared
+    edges = [
+        np.histogram_bin_edges(data[column].astype(float), bins=bins)
+        for column in columns
+    ]
+    groups = data.groupby(by, dropna=False) if by else [(None, data)]
+
+    frames = []
+    for key, group in groups:
+        counts, _ = np.histogramdd(group[columns].astype(float).to_numpy(),
+                                   bins=edges)
+        indices = np.nonzero(counts)
+        frame = pd.DataFrame({
+            column: (edges[i][indices[i]] + edges[i][indices[i] + 1]) / 2
+            for i, column in enumerate(columns)
+        })
+        frame["Model count"] = counts[indices].astype(int)
+        if by:
+            frame[by] = key
+        frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=columns + ["Model count"] + ([by] if by else []))
+    return pd.concat(frames, ignore_index=True)
+
+
+def parameter_scatter(data, x, y, z=None, color=None, title=None,
+                      density=False, bins=None):
+    '''
+    Scatter plot of the models (3D if z is given) using Plotly Express.
+    2D plots are drawn with WebGL when there are many models.
+    In density mode, the models are binned (see bin_points) and each marker
+    is a bin with a size proportional to its number of models.
+    '''
+    import plotly.express as px
+
+    columns = [x, y] if z is None else [x, y, z]
+    kwargs = {
+        "color": color,
+        "title": title,
+        "color_discrete_sequence": px.colors.qualitative.Safe,
+        "opacity": 0.7,
+    }
+    if density:
+        # fewer bins in 3D, the number of markers grows as bins**3
+        bins = bins or (40 if z is None else 15)
+        data = bin_points(data, columns, bins=bins, by=color)
+        kwargs |= {"size": "Model count", "hover_data": ["Model count"]}
+    else:
+        kwargs["hover_data"] = ["Model name"]
+
+    if z is None:
+        if len(data) > LARGE_PLOT_THRESHOLD:
+            kwargs["render_mode"] = "webgl"
+        return px.scatter(data, x=x, y=y, **kwargs)
+    # scatter_3d is always drawn with WebGL
+    return px.scatter_3d(data, x=x, y=y, z=z, **kwargs)
+
+
 def remove_upper_padding():
     '''
     Uses CSS to remove padding at the top of the page
@@ -0,0 +1,386 @@
+" Local snapshot of the index, used by the dashboard when Elasticsearch is unavailable "
+
+import itertools
+import json
+import threading
+import time
+
+# client methods used by the dashboard (see fdashboard.py) and by helpers.scan (see load_func.py)
+METHODS = ["search", "count", "mget", "open_point_in_time", "close_point_in_time",
+           "scroll", "clear_scroll"]
+
+# point in time id of the searches answered by the snapshot, and start of their scroll ids
+SNAPSHOT_PIT = "snapshot"
+
+
+class SnapshotError(Exception):
+    '''
+    Raised for requests the snapshot can't answer (e.g. query_string searches)
+    '''
+
+
+def read_snapshot(path) -> tuple:
+    '''
+    Read a snapshot written by SaveSnapshot (load_func.py)
+    Returns:
+        list of (id, document) and dictionary of information (index, created, count)
+    '''
+    import sqlite3
+
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        documents = [(id, json.loads(source)) for id, source in
+                     connection.execute("SELECT id, source FROM documents ORDER BY rowid")]
+        info = dict(connection.execute("SELECT key, value FROM info"))
+    finally:
+        connection.close()
+    return documents, info
+
+
+def _values(doc, field) -> list:
+    '''
+    Values of a field of a document as a list (keyword fields can hold several values)
+    '''
+    value = doc.get(field)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _matches(query, doc) -> bool:
+    '''
+    Evaluate the query clauses built by the dashboard (see build_query) on a document
+    '''
+    if not query or "match_all" in query:
+        return True
+    if "bool" in query:
+        clauses = {key: value if isinstance(value, list) else [value]
+                   for key, value in query["bool"].items()}
+        required = clauses.get("must", []) + clauses.get("filter", [])
+        if not all(_matches(clause, doc) for clause in required):
+            return False
+        if any(_matches(clause, doc) for clause in clauses.get("must_not", [])):
+            return False
+        # should clauses are optional when there are required clauses
+        should = clauses.get("should", [])
+        return not should or bool(required) or any(_matches(clause, doc) for clause in should)
+    if "range" in query:
+        (field, bounds), = query["range"].items()
+        return any(("gte" not in bounds or value >= bounds["gte"])
+                   and ("lte" not in bounds or value <= bounds["lte"])
+                   and ("gt" not in bounds or value > bounds["gt"])
+                   and ("lt" not in bounds or value < bounds["lt"])
+                   for value in _values(doc, field))
+    if "terms" in query:
+        (field, values), = query["terms"].items()
+        return any(value in values for value in _values(doc, field))
+    if "term" in query or "match" in query:
+        (field, value), = (query.get("term") or query.get("match")).items()
+        if isinstance(value, dict):
+            value = value.get("value", value.get("query"))
+        return value in _values(doc, field)
+    raise SnapshotError(f"{next(iter(query))} queries are not available offline")
+
+
+def _sort_fields(sort) -> list:
+    '''
+    List of (field, descending) of an Elasticsearch sort
+    '''
+    if isinstance(sort, (str, dict)):
+        sort = [sort]
+    fields = []
+    for item in sort:
+        if isinstance(item, str):
+            field, order = item, "asc"
+        else:
+            (field, order), = item.items()
+            if isinstance(order, dict):
+                order = order.get("order", "asc")
+        fields.append((field, order == "desc"))
+    return fields
+
+
+def _compare(a, b, fields) -> int:
+    '''
+    Compare two lists of sort values, missing values last as in Elasticsearch
+    '''
+    for (_, descending), x, y in zip(fields, a, b):
+        if x == y:
+            continue
+        if x is None or y is None:
+            return 1 if x is None else -1
+        return (1 if x > y else -1) * (-1 if descending else 1)
+    return 0
+
+
+class SnapshotClient:
+    '''
+    Read-only stand-in for the Elasticsearch client, answering the requests of the dashboard
+    (searches with ranges and terms filters, sorts, pages, aggregations, counts) from a snapshot
+    held in memory. Free-text (query_string) and kNN searches are not available.
+    '''
+
+    def __init__(self, path):
+        from datetime import datetime
+
+        documents, self.info = read_snapshot(path)
+        self.ids = [id for id, _ in documents]
+        self.documents = [doc for _, doc in documents]
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self.created = datetime.fromisoformat(self.info["created"])
+        # hits left to send by the scroll searches, {scroll id: (hits, size)}
+        self._scrolls = {}
+        self._scroll_ids = itertools.count()
+
+    def _select(self, query) -> list:
+        '''
+        (position, document) of the documents matching a query, in index order
+        '''
+        return [(i, doc) for i, doc in enumerate(self.documents) if _matches(query, doc)]
+
+    @staticmethod
+    def _source(doc, includes):
+        if includes is None:
+            return doc
+        return {field: doc[field] for field in includes if field in doc}
+
+    def count(self, index=None, body=None, **kwargs):
+        return {"count": len(self._select((body or kwargs).get("query")))}
+
+    def open_point_in_time(self, **kwargs):
+        # the snapshot doesn't change
+        return {"id": SNAPSHOT_PIT}
+
+    def close_point_in_time(self, **kwargs):
+        return {"succeeded": True, "num_freed": 1}
+
+    def scroll(self, scroll_id=None, body=None, **kwargs):
+        hits, size = self._scrolls.pop(scroll_id or body["scroll_id"])
+        return self._scroll_page(hits, size)
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        ids = scroll_id or (body or {}).get("scroll_id") or []
+        ids = [ids] if isinstance(ids, str) else ids
+        freed = sum(self._scrolls.pop(id, None) is not None for id in ids)
+        return {"succeeded": True, "num_freed": freed}
+
+    def _scroll_page(self, hits, size) -> dict:
+        '''
+        Response of a scroll search with the next size hits, the others are kept for the next request
+        '''
+        scroll_id = f"{SNAPSHOT_PIT}-{next(self._scroll_ids)}"
+        # kept until the scroll is cleared, even when empty (the next request gets no hits)
+        self._scrolls[scroll_id] = (hits[size:], size)
+        return {"_scroll_id": scroll_id, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                "hits": {"hits": hits[:size]}}
+
+    def mget(self, index=None, body=None, _source_includes=None, **kwargs):
+        docs = []
+        for id in (body or kwargs)["ids"]:
+            if id in self.positions:
+                doc = self.documents[self.positions[id]]
+                docs.append({"_index": self.info["index"], "_id": id, "found": True,
+                             "_source": self._source(doc, _source_includes)})
+            else:
+                docs.append({"_index": self.info["index"], "_id": id, "found": False})
+        return {"docs": docs}
+
+    def search(self, index=None, body=None, **kwargs):
+        import functools
+
+        start = time.perf_counter()
+        body = body or kwargs
+        if "knn" in body:
+            raise SnapshotError("kNN searches are not available offline")
+        selected = self._select(body.get("query"))
+
+        fields = _sort_fields(body.get("sort", []))
+
+        def values(entry):
+            position, doc = entry
+            # _doc and _shard_doc are the index order
+            return [position if field in ["_doc", "_shard_doc"] else doc.get(field)
+                    for field, _ in fields]
+
+        if fields:
+            selected.sort(key=functools.cmp_to_key(
+                lambda a, b: _compare(values(a), values(b), fields)))
+        if "search_after" in body:
+            selected = [entry for entry in selected
+                        if _compare(values(entry), body["search_after"], fields) > 0]
+
+        source = body.get("_source", True)
+        if isinstance(source, dict):
+            includes = source.get("includes")
+        elif isinstance(source, list):
+            includes = source
+        else:
+            includes = None
+
+        offset = body.get("from", body.get("from_", 0))
+        size = body.get("size", 10)
+        hits = []
+        # scroll searches (e.g. helpers.scan) get all the hits, sent size by size
+        for entry in selected[offset:] if "scroll" in body else selected[offset:offset + size]:
+            position, doc = entry
+            hit = {"_index": self.info["index"], "_id": self.ids[position], "_score": None}
+            if source is not False:
+                hit["_source"] = self._source(doc, includes)
+            if fields:
+                hit["sort"] = values(entry)
+            hits.append(hit)
+
+        response = self._scroll_page(hits, size) if "scroll" in body else {"hits": {"hits": hits}}
+        if body.get("track_total_hits", True) is not False:
+            response["hits"]["total"] = {"value": len(selected), "relation": "eq"}
+        aggregations = body.get("aggs") or body.get("aggregations")
+        if aggregations:
+            docs = [doc for _, doc in selected]
+            response["aggregations"] = {name: self._aggregate(aggregation, docs)
+                                        for name, aggregation in aggregations.items()}
+        if "pit" in body:
+            response["pit_id"] = SNAPSHOT_PIT
+        response["took"] = int((time.perf_counter() - start) * 1000)
+        return response
+
+    @staticmethod
+    def _aggregate(aggregation, docs) -> dict:
+        '''
+        Terms, min, max and composite (terms sources) aggregations
+        '''
+        from collections import Counter
+
+        if "terms" in aggregation:
+            terms = aggregation["terms"]
+            counts = Counter(value for doc in docs for value in set(_values(doc, terms["field"])))
+            # most frequent first, then by value as Elasticsearch does
+            buckets = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            return {"buckets": [{"key": key, "doc_count": count}
+                                for key, count in buckets[:terms.get("size", 10)]]}
+        if "min" in aggregation or "max" in aggregation:
+            function = min if "min" in aggregation else max
+            field = (aggregation.get("min") or aggregation["max"])["field"]
+            values = [value for doc in docs for value in _values(doc, field)]
+            return {"value": function(values) if values else None}
+        if "composite" in aggregation:
+            import itertools
+
+            composite = aggregation["composite"]
+            sources = [(name, source["terms"]["field"])
+                       for item in composite["sources"] for name, source in item.items()]
+            counts = Counter(key for doc in docs for key in
+                             itertools.product(*[set(_values(doc, field)) for _, field in sources]))
+            keys = sorted(counts)
+            if "after" in composite:
+                after = tuple(composite["after"][name] for name, _ in sources)
+                keys = [key for key in keys if key > after]
+            names = [name for name, _ in sources]
+            buckets = [{"key": dict(zip(names, key)), "doc_count": counts[key]}
+                       for key in keys[:composite.get("size", 10)]]
+            result = {"buckets": buckets}
+            if buckets:
+                result["after_key"] = buckets[-1]["key"]
+            return result
+        raise SnapshotError(f"{next(iter(aggregation))} aggregations are not available offline")
+
+
+class FallbackClient:
+    '''
+    Elasticsearch client answering from the snapshot when the cluster is unavailable.
+    The requests of the dashboard are sent to the cluster with a time budget (request_timeout);
+    if the cluster can't be reached, is too slow or fails (status >= 500), the request is
+    answered by the snapshot and the cluster is not tried again for retry_after seconds,
+    so the following requests don't wait for it. Other attributes are those of the client.
+    The snapshot is loaded in memory in the background when the client is created.
+    '''
+
+    def __init__(self, client, snapshot_path, budget=5.0, retry_after=30.0):
+        self.client = client
+        self.budget = budget
+        self.timed_client = client.options(request_timeout=budget)
+        # the clients returned by options share the state of this one
+        self._root = self
+        self.snapshot_path = snapshot_path
+        self.retry_after = retry_after
+        self.offline_until = 0.0
+        self._snapshot = None
+        self._snapshot_error = None
+        self._loaded = threading.Event()
+        threading.Thread(target=self._load, daemon=True).start()
+
+    def options(self, **kwargs):
+        '''
+        Same client with other transport options (e.g. used by helpers.scan), the requests
+        still fall back on the snapshot
+        '''
+        view = object.__new__(FallbackClient)
+        view.__dict__.update(self.__dict__)
+        view.client = self.client.options(**kwargs)
+        view.timed_client = view.client.options(request_timeout=self.budget)
+        return view
+
+    def _load(self):
+        try:
+            self._snapshot = SnapshotClient(self.snapshot_path)
+        except Exception as e:
+            self._snapshot_error = e
+        finally:
+            self._loaded.set()
+
+    @property
+    def snapshot(self) -> SnapshotClient:
+        '''
+        The snapshot client, waits for the snapshot to be loaded
+        '''
+        root = self._root
+        root._loaded.wait()
+        if root._snapshot is None:
+            raise SnapshotError(f"Snapshot {self.snapshot_path} unavailable: {root._snapshot_error}")
+        return root._snapshot
+
+    @property
+    def offline(self) -> bool:
+        '''
+        True if the requests are currently answered by the snapshot
+        '''
+        return time.monotonic() < self._root.offline_until
+
+    @staticmethod
+    def _unavailable(error) -> bool:
+        '''
+        True if an error means the cluster is unavailable (rather than a wrong request)
+        '''
+        from elasticsearch import ApiError, TransportError
+
+        if isinstance(error, TransportError):
+            # connection errors and timeouts
+            return True
+        return isinstance(error, ApiError) and error.meta.status >= 500
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            return getattr(self.client, name)
+
+        def call(**kwargs):
+            body = kwargs.get("body") or {}
+            pit = body.get("pit", {}).get("id") if isinstance(body, dict) else None
+            # point in time or scroll continued by the request
+            cursor = kwargs.get("scroll_id") if name == "scroll" else pit
+            # a point in time or scroll opened on the snapshot is read until the end from it,
+            # and one opened on the cluster can't be continued from the snapshot
+            if any(str(value).startswith(SNAPSHOT_PIT)
+                   for value in [pit, kwargs.get("id"), kwargs.get("scroll_id")]):
+                return getattr(self.snapshot, name)(**kwargs)
+            if self.offline and cursor is None:
+                return getattr(self.snapshot, name)(**kwargs)
+            try:
+                return getattr(self.timed_client, name)(**kwargs)
+            except Exception as e:
+                if not self._unavailable(e):
+                    raise
+                self._root.offline_until = time.monotonic() + self.retry_after
+                if cursor is not None:
+                    raise
+                return getattr(self.snapshot, name)(**kwargs)
+
+        return call
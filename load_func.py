@@ -2,8 +2,32 @@
 
 from typing import Dict, Any
 
+# Parameters used to build the normalised parameter vector of each model (for similarity searches),
+# with the range used to scale them between 0 and 1.
+# Quantities spanning several orders of magnitude are scaled logarithmically.
+SIMILARITY_FIELDS = {
+    # field: (min, max, log scale)
+    "eccentricity": (0.0, 1.0, False),
+    "mass_ratio": (0.0, 2.0, False),
+    "semi_major_axis": (1.0, 1000.0, True),
+    "primary_mass": (0.5, 5.0, False),
+    "wind_velocity": (1.0, 50.0, False),
+    "wind_mass_rate": (1e-8, 1e-4, True),
+}
+
+# Grid used to follow the coverage of the parameter space by the models (see CoverageGrid)
+COVERAGE_FIELDS = {
+    # field: (min, max, number of bins, log scale)
+    "eccentricity": (0.0, 1.0, 10, False),
+    "mass_ratio": (0.0, 2.0, 10, False),
+    "semi_major_axis": (1.0, 1000.0, 12, True),
+    "wind_velocity": (0.0, 40.0, 8, False),
+    "wind_mass_rate": (1e-8, 1e-4, 8, True),
+}
+
 def calculate_period(semi_major_axis: float, primary_mass: float, secondary_mass: float) -> float:
     ''' Calculate the period of a binary system from the semi-major axis and the masses of the two stars
+    Also works with numpy arrays, to compute the periods of many models at once (see DeriveFields)
     Args:
         semi_major_axis: semi-major axis of the binary system, in au
         primary_mass: mass of the primary star, in Msol
@@ -45,14 +69,107 @@ def read_csv(file_path: str) -> list:
     return data, header
 
 
-def create_mapping(data: list, header: list) -> Dict[str, Any]:
+def parameter_vector(entries: dict) -> list:
+    """Build the normalised parameter vector of a model, used to find similar models
+    Args:
+        entries: dictionary containing the fields of SIMILARITY_FIELDS (e.g. the model data)
+        Missing fields (e.g. binary parameters of single stars) are set to the minimum of their range.
+    Returns:
+        List of floats, one per field of SIMILARITY_FIELDS, scaled between 0 and 1 within the range of the field
+    """
+    import math
+
+    vector = []
+    for field, (vmin, vmax, log) in SIMILARITY_FIELDS.items():
+        value = entries.get(field)
+        if value is None:
+            value = vmin
+        if log:
+            # clip to the range so the log is defined
+            value = math.log10(max(value, vmin))
+            vmin, vmax = math.log10(vmin), math.log10(vmax)
+        vector.append((value - vmin) / (vmax - vmin))
+    return vector
+
+
+# Indexing profiles of the fields, set in the "profile" column of metadata.csv.
+# Fields that are fully indexed (profile 0) can be searched quickly, the others save space and indexing time:
+INDEX_PROFILES = {
+    # displayed but rarely searched: no index, the (slower) searches, sorts and aggregations use the doc values.
+    # The doc values are kept so that query_string searches on all the fields still work
+    "docvalues": {"index": False},
+    # field sorting the index (see create_settings), fully indexed
+    "sort": {},
+    # keyword searched as you type (see suggest_models): a "typeahead" subfield indexes the prefixes
+    # of the parts of the value starting after a "_", using the analyzers of TYPEAHEAD_ANALYSIS
+    "typeahead": {"fields": {"typeahead": {"type": "text",
+                                           "analyzer": "typeahead",
+                                           "search_analyzer": "typeahead_search"}}},
+}
+
+# longest prefix indexed by the typeahead subfields (each name has about 40 parts, so a
+# longer prefix multiplies the terms of the index), longer texts are checked with a wildcard
+TYPEAHEAD_MAX_GRAM = 24
+# analyzers of the typeahead profile, added to the settings of the index (see create_settings)
+TYPEAHEAD_ANALYSIS = {
+    "tokenizer": {
+        # "a_b_c" -> "a_b_c", "b_c", "c"
+        "name_parts": {"type": "path_hierarchy", "delimiter": "_", "reverse": True}
+    },
+    "filter": {
+        "prefixes": {"type": "edge_ngram", "min_gram": 1, "max_gram": TYPEAHEAD_MAX_GRAM}
+    },
+    "analyzer": {
+        "typeahead": {"type": "custom", "tokenizer": "name_parts", "filter": ["lowercase", "prefixes"]},
+        # the text typed is searched as a whole
+        "typeahead_search": {"type": "custom", "tokenizer": "keyword", "filter": ["lowercase"]},
+    },
+}
+
+
+def index_profile(profile: str) -> Dict[str, Any]:
+    """Mapping parameters of an indexing profile (see INDEX_PROFILES)
+    "scaled:<factor>" stores a float as a long (value * factor), for parameters with a known precision
+    """
+    if profile.startswith("scaled:"):
+        return {"type": "scaled_float", "scaling_factor": float(profile.split(":")[1])}
+    if profile not in INDEX_PROFILES:
+        raise ValueError(f"Unknown indexing profile {profile}, check metadata.csv")
+    return dict(INDEX_PROFILES[profile])
+
+
+def create_settings(data: list, header: list, settings: dict = None) -> Dict[str, Any]:
+    """Create the settings of the index, sorted on the fields with the "sort" profile (newest first).
+    Searches sorted the same way (e.g. the most recent models) can then stop early.
+    The analyzers of the "typeahead" profile are added if a field uses it.
+    Args:
+        data, header: content of metadata.csv (see read_csv)
+        settings: other settings of the index
+    Returns:
+        Dictionary of settings
+    """
+    settings = dict(settings or {})
+    if "profile" in header:
+        profiles = [item[header.index("profile")] for item in data]
+        fields = [item[0] for item, profile in zip(data, profiles) if profile == "sort"]
+        if fields:
+            settings["sort.field"] = fields
+            settings["sort.order"] = ["desc"] * len(fields)
+        if "typeahead" in profiles:
+            settings["analysis"] = TYPEAHEAD_ANALYSIS
+    return settings
+
+
+def create_mapping(data: list, header: list, profiles: bool = True) -> Dict[str, Any]:
     """Create dictionary for db mappings
     Args:
-        data: list of lists of len(5) containing each mapping's label and the
+        data: list of lists of len(6) containing each mapping's label and the
         corresponding metadata.
         First element of each list is the label, second is the type of variable stored,
         third is the format (blank for most, only used for date for now)
         fourth and fifth are the units and file storing the information (both can be 0),
+        sixth is the indexing profile of the field (see INDEX_PROFILES, 0 for the default indexing)
+        profiles: if False, the indexing profiles are ignored and all the fields are fully indexed
         
     Returns:
         Dictionary containing the mapping labels and metadata
@@ -67,10 +184,18 @@ def create_mapping(data: list, header: list) -> Dict[str, Any]:
         # if the field comes with metadata, add it
         meta = {}
         for i in range(3, len(item)):
-            if item[i] != "0":
+            if item[i] != "0" and header[i] != "profile":
                 meta[header[i]] = item[i]
         if meta:
             data_dict[item[0]]["meta"] = meta
+        # how the field is indexed
+        if profiles and "profile" in header and item[header.index("profile")] != "0":
+            data_dict[item[0]].update(index_profile(item[header.index("profile")]))
+        # vectors used for similarity searches (see parameter_vector)
+        if item[1] == "dense_vector":
+            data_dict[item[0]].update({"dims": len(SIMILARITY_FIELDS),
+                                       "index": True,
+                                       "similarity": "l2_norm"})
     return data_dict
  
 def read_model_list(file) -> list:
@@ -104,12 +229,933 @@ def query_document(client, index: str, query: str) -> str:
     return id
 
 
-def LoadDoc(directory: str, model, prefix: str, index_definition) -> Dict[str, Any]:
-    """Load document from the files in the simulation directory
+class SimilarityIndex:
+    """Local nearest neighbour index of the parameter vectors of the models.
+    Used to find similar models when the cluster can't run kNN queries
+    (e.g. documents uploaded before the parameter_vector field was added).
+    Uses a KD-tree if scipy is installed, and a brute force search otherwise.
+    """
+
+    def __init__(self, names: list, vectors: list):
+        import numpy as np
+
+        self.names = list(names)
+        self.vectors = np.asarray(vectors, dtype=float).reshape(len(self.names), len(SIMILARITY_FIELDS))
+        try:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(self.vectors)
+        except ImportError:
+            self._tree = None
+
+    @classmethod
+    def from_index(cls, client, index: str):
+        """Build the local index from the parameters of all the documents of an elastic search index"""
+        from elasticsearch import helpers
+
+        names = []
+        vectors = []
+        for hit in helpers.scan(client, index=index, query={"query": {"match_all": {}}},
+                                _source=["Model name"] + list(SIMILARITY_FIELDS)):
+            names.append(hit["_source"]["Model name"])
+            vectors.append(parameter_vector(hit["_source"]))
+        return cls(names, vectors)
+
+    def query(self, vector: list, k: int = 10) -> list:
+        """Find the k models closest to a parameter vector
+        Returns:
+            List of (model name, distance) tuples, closest first
+        """
+        import numpy as np
+
+        k = min(k, len(self.names))
+        if k == 0:
+            return []
+        if self._tree is not None:
+            distances, indices = self._tree.query(vector, k=k)
+            distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+        else:
+            all_distances = np.linalg.norm(self.vectors - np.asarray(vector, dtype=float), axis=1)
+            indices = np.argsort(all_distances)[:k]
+            distances = all_distances[indices]
+        return [(self.names[i], float(d)) for i, d in zip(indices, distances)]
+
+
+class CoverageGrid:
+    """Sparse occupancy grid of the parameter space, counting the models in each cell.
+    A cell is a tuple with the bin index of each field of the grid.
+    Only the occupied cells are stored, so counting the models of a cell takes constant time.
+    The occupied cells are also indexed by number of models, so the sparse cells are counted
+    without going through the whole grid.
+    The grid is updated at each upload (add/remove) and saved as a json file.
+    Models missing one of the fields (e.g. single stars) are not counted.
+    """
+
+    def __init__(self, fields: dict = None, counts: dict = None):
+        self.fields = dict(fields or COVERAGE_FIELDS)
+        self.counts = {}
+        # occupied cells by number of models, {count: set of cells}, updated by add
+        self.by_count = {}
+        for cell, count in (counts or {}).items():
+            self.add_to_cell(cell, count)
+
+    def bin_edges(self, field: str) -> list:
+        """Edges of the bins of a field"""
+        vmin, vmax, nbins, log = self.fields[field]
+        if log:
+            return [vmin * (vmax / vmin)**(i / nbins) for i in range(nbins + 1)]
+        return [vmin + (vmax - vmin) * i / nbins for i in range(nbins + 1)]
+
+    def cell(self, entries: dict):
+        """Cell of a model, None if one of the fields is missing.
+        Values outside of the range of a field are put in the first or last bin.
+        """
+        import math
+
+        cell = []
+        for field, (vmin, vmax, nbins, log) in self.fields.items():
+            value = entries.get(field)
+            if value is None:
+                return None
+            if log:
+                value = math.log10(max(value, vmin))
+                vmin, vmax = math.log10(vmin), math.log10(vmax)
+            cell.append(min(max(int((value - vmin) / (vmax - vmin) * nbins), 0), nbins - 1))
+        return tuple(cell)
+
+    def add(self, entries: dict, n: int = 1):
+        """Count a model (n=-1 removes it)"""
+        cell = self.cell(entries)
+        if cell is None:
+            return
+        self.add_to_cell(cell, n)
+
+    def add_to_cell(self, cell: tuple, n: int):
+        """Change the number of models of a cell by n"""
+        old = self.counts.get(cell, 0)
+        new = old + n
+        if old > 0:
+            self.by_count[old].discard(cell)
+            if not self.by_count[old]:
+                del self.by_count[old]
+        if new > 0:
+            self.counts[cell] = new
+            self.by_count.setdefault(new, set()).add(cell)
+        else:
+            self.counts.pop(cell, None)
+
+    def remove(self, entries: dict):
+        """Remove a model, e.g. before updating it"""
+        self.add(entries, n=-1)
+
+    def count(self, cell: tuple) -> int:
+        """Number of models in a cell"""
+        return self.counts.get(tuple(cell), 0)
+
+    def cells(self, ranges: dict = None):
+        """Iterate over all the cells of the grid
+        Args:
+            ranges: optional dictionary {field: (first bin, last bin)} restricting the cells
+        """
+        import itertools
+
+        ranges = ranges or {}
+        bins = [range(ranges.get(field, (0, nbins - 1))[0], ranges.get(field, (0, nbins - 1))[1] + 1)
+                for field, (_, _, nbins, _) in self.fields.items()]
+        return itertools.product(*bins)
+
+    def size(self, ranges: dict = None) -> int:
+        """Number of cells of the grid
+        Args:
+            ranges: optional dictionary {field: (first bin, last bin)} restricting the cells
+        """
+        import math
+
+        ranges = ranges or {}
+        return math.prod(ranges.get(field, (0, nbins - 1))[1] - ranges.get(field, (0, nbins - 1))[0] + 1
+                         for field, (_, _, nbins, _) in self.fields.items())
+
+    def in_ranges(self, cell: tuple, ranges: dict = None) -> bool:
+        """Whether a cell is within ranges {field: (first bin, last bin)}"""
+        ranges = ranges or {}
+        return all(field not in ranges or ranges[field][0] <= i <= ranges[field][1]
+                   for field, i in zip(self.fields, cell))
+
+    def count_sparse(self, max_count: int = 0, ranges: dict = None) -> int:
+        """Number of cells containing at most max_count models (empty cells by default).
+        Takes max_count steps for the whole grid, and goes through the occupied cells with ranges.
+        """
+        if ranges:
+            return self.size(ranges) - sum(1 for cell, count in self.counts.items()
+                                           if count > max_count and self.in_ranges(cell, ranges))
+        return self.size() - len(self.counts) + sum(len(self.by_count.get(count, ()))
+                                                    for count in range(1, max_count + 1))
+
+    def sparse_cells(self, max_count: int = 0, ranges: dict = None, limit: int = None) -> list:
+        """Cells containing at most max_count models (empty cells by default),
+        the empty cells first, then by number of models.
+        Args:
+            max_count: maximum number of models in a cell
+            ranges: optional dictionary {field: (first bin, last bin)} restricting the cells
+            limit: maximum number of cells returned. The empty cells are listed until the limit
+                   is reached, skipping the occupied ones, so the whole grid is not gone through.
+        """
+        import itertools
+
+        # the empty cells are those not stored
+        cells = list(itertools.islice((cell for cell in self.cells(ranges) if cell not in self.counts),
+                                      limit))
+        for count in range(1, max_count + 1):
+            if limit is not None and len(cells) >= limit:
+                break
+            cells += sorted(cell for cell in self.by_count.get(count, ())
+                            if not ranges or self.in_ranges(cell, ranges))
+        return cells[:limit]
+
+    def describe_cell(self, cell: tuple) -> dict:
+        """Range of values of each field in a cell, {field: (min, max)}"""
+        description = {}
+        for field, i in zip(self.fields, cell):
+            edges = self.bin_edges(field)
+            description[field] = (edges[i], edges[i + 1])
+        return description
+
+    def project(self, fields: list) -> dict:
+        """Number of models in each cell of the grid restricted to some fields, {sub-cell: count}"""
+        indices = [list(self.fields).index(field) for field in fields]
+        projection = {}
+        for cell, count in self.counts.items():
+            sub_cell = tuple(cell[i] for i in indices)
+            projection[sub_cell] = projection.get(sub_cell, 0) + count
+        return projection
+
+    def save(self, file: str):
+        """Save the grid to a json file"""
+        import json
+
+        with open(file, "w") as f:
+            json.dump({"fields": self.fields,
+                       "counts": [list(cell) + [count] for cell, count in self.counts.items()]},
+                      f)
+
+    @classmethod
+    def load(cls, file: str):
+        """Load a grid saved with save"""
+        import json
+
+        with open(file) as f:
+            data = json.load(f)
+        return cls({field: tuple(v) for field, v in data["fields"].items()},
+                   {tuple(c[:-1]): c[-1] for c in data["counts"]})
+
+    @classmethod
+    def from_index(cls, client, index: str, fields: dict = None):
+        """Build the grid from all the documents of an elastic search index"""
+        from elasticsearch import helpers
+
+        grid = cls(fields)
+        for hit in helpers.scan(client, index=index, query={"query": {"match_all": {}}},
+                                _source=list(grid.fields)):
+            grid.add(hit["_source"])
+        return grid
+
+
+def get_parameter_vector(client, index: str, model: str) -> list:
+    """Get the parameter vector of a model of the index, from its stored parameters
+    Args:
+        client: elasticsearch client
+        index (str): elastic search index
+        model (str): name of the model
+
+    Returns:
+        parameter vector of the model (see parameter_vector), None if the model does not exist
+    """
+    response = client.search(index=index,
+                             query={"term": {"Model name": model}},
+                             source=list(SIMILARITY_FIELDS), size=1)
+    if len(response["hits"]["hits"]) == 0:
+        return None
+    return parameter_vector(response["hits"]["hits"][0]["_source"])
+
+
+def find_similar(client, index: str, target, k: int = 10, local_index=None) -> list:
+    """Find the models with the closest parameters to a model or to a set of parameters.
+    Uses a kNN query on the parameter_vector field, or the local index if the query fails.
+     Args:
+        client: elasticsearch client
+        index (str): elastic search index
+        target: name of a model, or dictionary of parameters (fields of SIMILARITY_FIELDS)
+        k (int): number of models to return
+        local_index: SimilarityIndex used as a fallback, or function returning one (e.g. a cached one).
+        Built from the index if None.
+
+    Returns:
+        List of (model name, distance) tuples, closest first. A model is not returned as similar to itself.
+    """
+    import math
+
+    if isinstance(target, str):
+        vector = get_parameter_vector(client, index, target)
+        if vector is None:
+            return []
+        # the model itself is always found, ask for one more
+        n = k + 1
+    else:
+        vector = parameter_vector(target)
+        n = k
+
+    try:
+        response = client.search(index=index,
+                                 knn={"field": "parameter_vector",
+                                      "query_vector": vector,
+                                      "k": n,
+                                      "num_candidates": max(100, 10 * n)},
+                                 source=["Model name"], size=n)
+        # with the l2_norm similarity, score = 1 / (1 + distance**2)
+        results = [(hit["_source"]["Model name"], math.sqrt(max(1 / hit["_score"] - 1, 0)))
+                   for hit in response["hits"]["hits"]]
+    except Exception as e:
+        print(f"kNN query failed ({e}), using the local index")
+        if local_index is None:
+            local_index = SimilarityIndex.from_index(client, index)
+        elif callable(local_index):
+            local_index = local_index()
+        results = local_index.query(vector, n)
+
+    return [r for r in results if r[0] != target][:k]
+
+
+def name_parts(name: str) -> list:
+    """Parts of a model name searched as you type: the name and what follows each "_", in lowercase
+    (same as the typeahead analyzer, see TYPEAHEAD_ANALYSIS)
+    """
+    name = name.lower()
+    return [name] + [name[i + 1:] for i, c in enumerate(name) if c == "_" and i + 1 < len(name)]
+
+
+# the fuzzy search of ModelNameIndex looks up the changes in the first characters of the text,
+# and checks the names starting with them for changes further on
+FUZZY_LOOKUP_LENGTH = 4
+
+
+def one_edit_prefix(text: str, name: str) -> bool:
+    """True if name starts with text with at most one character changed, added or removed"""
+    import os
+
+    k = len(os.path.commonprefix([text, name]))
+    return (k == len(text)
+            or name.startswith(text[k + 1:], k + 1)
+            or name.startswith(text[k + 1:], k)
+            or name.startswith(text[k:], k + 1))
+
+
+class ModelNameIndex:
+    """Local type-ahead index of the model names, used when the cluster can't answer (see suggest_models).
+    The parts of the names (see name_parts) are kept sorted, so finding the names containing
+    a text at the start of a part is a binary search.
+    """
+
+    def __init__(self, names: list):
+        # without duplicates, in the order given
+        self.names = list(dict.fromkeys(names))
+        self._names = sorted((name.lower(), i) for i, name in enumerate(self.names))
+        self._parts = sorted((part, i) for i, name in enumerate(self.names) for part in name_parts(name))
+        # characters tried by the fuzzy search
+        self._alphabet = sorted({c for name, _ in self._names for c in name})
+
+    @classmethod
+    def from_file(cls, file: str):
+        """Build the local index from a list of models (e.g. model_list.txt, see read_model_list)"""
+        return cls([model for model in read_model_list(file) if model])
+
+    @classmethod
+    def from_index(cls, client, index: str):
+        """Build the local index from the names of all the documents of an elastic search index"""
+        from elasticsearch import helpers
+
+        return cls([hit["_source"]["Model name"]
+                    for hit in helpers.scan(client, index=index, query={"query": {"match_all": {}}},
+                                            _source=["Model name"])])
+
+    @staticmethod
+    def _starting_with(entries: list, text: str):
+        """(name index, entry) of the sorted entries starting with text"""
+        import bisect
+
+        for j in range(bisect.bisect_left(entries, (text, -1)), len(entries)):
+            if not entries[j][0].startswith(text):
+                break
+            yield entries[j][1], entries[j][0]
+
+    def search(self, text: str, size: int = 10, fuzzy: bool = True) -> list:
+        """Find the models whose name contains a text at the start of a part, ignoring case.
+        The names starting with the text come first. If fuzzy, texts of 3 characters or more also
+        match with one character changed, added or removed, after the exact matches.
+        Returns:
+            List of model names
+        """
+        import itertools
+
+        text = text.lower()
+        if not text:
+            return []
+        found = {}
+        for entries in (self._names, self._parts):
+            for i, _ in self._starting_with(entries, text):
+                found.setdefault(i, None)
+                if len(found) >= size:
+                    return [self.names[i] for i in found]
+
+        if fuzzy and len(text) >= 3:
+            # as in suggest_models, the first character has to match. Names with a change after
+            # the first characters are among those starting with them, checked one by one
+            start = text[:FUZZY_LOOKUP_LENGTH]
+            candidates = self._starting_with(self._parts, start)
+            # and the few changes in the first characters are looked up
+            variants = {}
+            for j in range(1, len(start)):
+                variants[text[:j] + text[j + 1:]] = None
+                for c in self._alphabet:
+                    variants[text[:j] + c + text[j + 1:]] = None
+                    variants[text[:j] + c + text[j:]] = None
+            for i in itertools.chain(
+                    (i for i, part in candidates if one_edit_prefix(text, part)),
+                    (i for variant in variants for i, _ in self._starting_with(self._parts, variant))):
+                found.setdefault(i, None)
+                if len(found) >= size:
+                    break
+        return [self.names[i] for i in found]
+
+
+# whether the indices have the typeahead subfield, {index: (time checked, mapped)} (see typeahead_mapped)
+_TYPEAHEAD_MAPPED = {}
+# the mappings are checked again after this time in s, to see a rebuilt index
+TYPEAHEAD_MAPPING_TTL = 300
+
+
+def typeahead_mapped(client, index: str) -> bool:
+    """Whether the typeahead subfield of "Model name" is mapped in an index (or all the indices of an alias).
+    Queries on an unmapped field don't fail, they find nothing, so an index created before the
+    typeahead profile would never suggest any model. The answer is cached for TYPEAHEAD_MAPPING_TTL s.
+    """
+    import time
+
+    checked, mapped = _TYPEAHEAD_MAPPED.get(index, (None, None))
+    if checked is None or time.monotonic() - checked > TYPEAHEAD_MAPPING_TTL:
+        response = client.indices.get_field_mapping(index=index, fields="Model name.typeahead")
+        mapped = bool(response) and all("Model name.typeahead" in mappings.get("mappings", {})
+                                        for mappings in dict(response).values())
+        _TYPEAHEAD_MAPPED[index] = (time.monotonic(), mapped)
+    return mapped
+
+
+def suggest_models(client, index: str, text: str, size: int = 10, fuzzy: bool = True,
+                   local_index=None) -> list:
+    """Find the models whose name contains a text, as it is typed (type-ahead).
+    The text is searched at the start of the name or after a "_", ignoring case,
+    on the typeahead subfield of "Model name" (see INDEX_PROFILES), or in the local index if the
+    subfield is not mapped (index created before the typeahead profile) or the query fails.
+     Args:
+        client: elasticsearch client
+        index (str): elastic search index
+        text (str): start of the model name, or of a part of it (e.g. "a_30.0_e_0.3")
+        size (int): number of models to return
+        fuzzy (bool): also find the names with a few characters changed, after the exact matches
+                      (only for texts up to TYPEAHEAD_MAX_GRAM characters)
+        local_index: ModelNameIndex used as a fallback, or function returning one (e.g. a cached one).
+        Built from the index if None.
+
+    Returns:
+        List of model names, those starting with the text first
+    """
+    if not text:
+        return []
+    # the typeahead subfield only indexes the first TYPEAHEAD_MAX_GRAM characters of each part
+    short = text.lower()[:TYPEAHEAD_MAX_GRAM]
+    prefix = {"prefix": {"Model name": {"value": text, "case_insensitive": True, "boost": 4}}}
+    if len(text) > TYPEAHEAD_MAX_GRAM:
+        # the models with a part starting with the first characters, and containing the whole text
+        pattern = "".join("\\" + c if c in "*?\\" else c for c in text)
+        query = {"bool": {"filter": [{"term": {"Model name.typeahead": short}},
+                                     {"wildcard": {"Model name": {"value": f"*{pattern}*",
+                                                                  "case_insensitive": True}}}],
+                          "should": [prefix]}}
+    else:
+        should = [prefix, {"term": {"Model name.typeahead": {"value": short, "boost": 2}}}]
+        if fuzzy:
+            should.append({"match": {"Model name.typeahead": {"query": short, "fuzziness": "AUTO",
+                                                              "prefix_length": 1}}})
+        query = {"bool": {"should": should}}
+    names = None
+    try:
+        if typeahead_mapped(client, index):
+            response = client.search(index=index, query=query,
+                                     sort=["_score", {"Model name": "asc"}],
+                                     source=["Model name"], size=size)
+            names = [hit["_source"]["Model name"] for hit in response["hits"]["hits"]]
+    except Exception as e:
+        print(f"Type-ahead query failed ({e}), using the local index")
+    if names is None:
+        if local_index is None:
+            local_index = ModelNameIndex.from_index(client, index)
+        elif callable(local_index):
+            local_index = local_index()
+        names = local_index.search(text, size, fuzzy)
+    return names
+
+
+class MemoryFiles:
+    '''
+    Contents of the files of a model, read in advance (see PrefetchModels).
+    The loaders (LoadSetupData, LoadEvData, ...) read them instead of the files on disk.
+    Args:
+        contents: dictionary {file name: bytes}
+        names: names of all the files of the model directory, including those that were not read
+    '''
+
+    def __init__(self, contents: dict, names: list = None):
+        self.contents = contents
+        self.names = list(contents) if names is None else names
+
+    def open(self, name: str):
+        import io
+
+        if name not in self.contents:
+            raise FileNotFoundError(name)
+        return io.StringIO(self.contents[name].decode("utf-8", errors="replace"))
+
+    def listdir(self) -> list:
+        return self.names
+
+    def size(self) -> int:
+        return sum(len(content) for content in self.contents.values())
+
+
+def open_model_file(directory: str, name: str, files=None):
+    """Open a file of a model, from files (see MemoryFiles) if given, from the disk otherwise"""
+    import os
+
+    if files is not None:
+        return files.open(name)
+    return open(os.path.join(directory, name), "r")
+
+
+def list_model_files(directory: str, files=None) -> list:
+    """Names of the files of a model, from files (see MemoryFiles) if given, from the disk otherwise"""
+    import os
+
+    if files is not None:
+        return files.listdir()
+    try:
+        return os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+
+def latest_ev_file(names: list, prefix: str) -> str:
+    """The .ev file with the largest number (e.g. wind12.ev), None if there is none"""
+    max_number = -1
+    max_file = None
+    for file in names:
+        if not file.endswith(".ev"):
+            continue
+        # extract the number from the filenames
+        try:
+            number = int(file.split(prefix)[1].split(".ev")[0])
+        except (ValueError, IndexError):
+            continue
+        if number > max_number:
+            max_number = number
+            max_file = file
+    return max_file
+
+
+def model_file_names(files: list, prefix: str, names: list) -> list:
+    """Names of the files read by the loaders of files (keys of FILE_LOADERS, see plan_files)
+    Args:
+        files (list): keys of FILE_LOADERS
+        prefix (str): prefix used for the files
+        names (list): names of the files of the model directory
+    """
+    wanted = {
+        ".setup": ["%s.setup" % prefix],
+        ".in": ["%s.in" % prefix],
+        "header.txt": ["header.txt"],
+        ".ev": [latest_ev_file(names, prefix)],
+        "wind_1D.dat": ["wind_1D.dat", "windprofile1D.dat"],
+    }
+    return [name for file in files for name in wanted[file] if name in names]
+
+
+class PrefetchModels:
+    '''
+    Iterates over models, reading the files needed by LoadDoc for the next models in a pool of threads
+    while the current one is processed. On a network file system, the many small reads of the
+    models then overlap instead of waiting for each other.
+    Yields (model, files) where files is a MemoryFiles to pass to LoadDoc.
+    Args:
+        directory (str): directory containing the models
+        models (list): names of the models
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        fields (list): optional fields loaded (see plan_files)
+        depth (int): number of models read in advance, the files of at most depth models are kept in memory
+        workers (int): number of threads reading the files
+    '''
+
+    def __init__(self, directory: str, models: list, prefix: str, index_definition,
+                 fields: list = None, depth: int = 8, workers: int = 8):
+        self.directory = directory
+        self.models = models
+        self.prefix = prefix
+        self.files = plan_files(index_definition, prefix, fields)
+        self.depth = depth
+        self.workers = workers
+
+    def read(self, model: str) -> MemoryFiles:
+        '''
+        Read the files of a model needed by LoadDoc
+        '''
+        import os
+
+        directory = os.path.join(self.directory, model)
+        # the directory is listed once, the listing is kept with the files (e.g. for LoadEvData)
+        # and used instead of stat calls to find the files
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            # LoadDoc reports the missing files
+            return MemoryFiles({}, [])
+        contents = {}
+        for name in model_file_names(self.files, self.prefix, names):
+            with open(os.path.join(directory, name), "rb") as f:
+                contents[name] = f.read()
+        return MemoryFiles(contents, names)
+
+    def __iter__(self):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            models = iter(self.models)
+            for model in models:
+                pending.append((model, pool.submit(self.read, model)))
+                if len(pending) >= self.depth:
+                    break
+            while pending:
+                model, future = pending.popleft()
+                files = future.result()
+                # keep depth models in flight
+                for next_model in models:
+                    pending.append((next_model, pool.submit(self.read, next_model)))
+                    break
+                yield model, files
+
+
+# extensions of the archives read by ArchiveModels
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".zip")
+
+
+def split_archive_path(path: str) -> tuple:
+    """Split the "path to folder" of a model loaded from an archive (see ArchiveModels)
+    Returns:
+        (path of the archive, directory of the model in the archive),
+        or (None, path) if the model is not in an archive
+    """
+    import os
+
+    parts = path.split(os.sep)
+    for i in range(1, len(parts)):
+        archive = os.sep.join(parts[:i])
+        if archive.endswith(ARCHIVE_SUFFIXES) and os.path.isfile(archive):
+            return archive, "/".join(parts[i:])
+    return None, path
+
+
+def archive_members(archive: str):
+    """Generator yielding the files of a .tar, .tar.gz or .zip archive, in the order of the archive,
+    without extracting it. The archive is read once, from start to end.
+
+    Yields:
+        (path in the archive, size, modification time, open), where open() returns a file object
+        reading the file, only valid until the next file is yielded
+    """
+    import tarfile
+    import time
+    import zipfile
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zip_archive:
+            for info in zip_archive.infolist():
+                if not info.is_dir():
+                    yield (info.filename, info.file_size, time.mktime(info.date_time + (0, 0, -1)),
+                           lambda info=info: zip_archive.open(info))
+    else:
+        # streaming mode: the archive (possibly compressed) is read sequentially
+        with tarfile.open(archive, "r|*") as tar_archive:
+            for member in tar_archive:
+                if member.isfile():
+                    yield (member.name, member.size, member.mtime,
+                           lambda member=member: tar_archive.extractfile(member))
+
+
+class ArchiveModels:
+    '''
+    Iterates over the models stored in a .tar, .tar.gz or .zip archive, without extracting it.
+    The files needed by LoadDoc are read in a single pass over the archive, the other files
+    (e.g. the dumps) are skipped, and only the end of the latest .ev file is kept.
+    Each model is yielded as soon as its files are read, so only one model is held in memory:
+    the files of a model have to be next to each other in the archive (as tar and zip write them).
+    Yields (model, files) like PrefetchModels, where model is the directory of the model in the archive
+    (e.g. runs/wind/model_1). The "path to folder" of the models loaded with LoadDoc(archive, model, ...)
+    is then archive/runs/wind/model_1, and their "Model name" model_1.
+    Args:
+        archive (str): path of the archive
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        fields (list): optional fields loaded (see plan_files)
+        models (list): optional names or directories in the archive of the models to load,
+                       all the models of the archive if None
+    '''
+
+    # only the last lines of the .ev files are used (see LoadEvData)
+    EV_TAIL = 65536
+
+    def __init__(self, archive: str, prefix: str, index_definition, fields: list = None,
+                 models: list = None):
+        self.archive = archive
+        self.prefix = prefix
+        self.files = plan_files(index_definition, prefix, fields)
+        self.models = None if models is None else set(models)
+        # names of the files read, the .ev files are chosen once all the names are known
+        self.wanted = set(model_file_names([file for file in self.files if file != ".ev"], prefix,
+                                           ["%s.setup" % prefix, "%s.in" % prefix, "header.txt",
+                                            "wind_1D.dat", "windprofile1D.dat"]))
+
+    def _members(self):
+        '''
+        Generator yielding (path, reader) for each file of the archive, in the order of the archive.
+        reader(size) returns the content of the file, or its last size bytes.
+        '''
+        def tail(f, size):
+            with f:
+                if size is None:
+                    return f.read()
+                data = b""
+                while chunk := f.read(1 << 20):
+                    data = (data + chunk)[-size:]
+                return data
+
+        for path, _, _, open_member in archive_members(self.archive):
+            yield path, lambda size, open_member=open_member: tail(open_member(), size)
+
+
+    def __iter__(self):
+        import posixpath
+
+        # directories being read, {directory: (names, files)}. The archives list the directories
+        # depth first, so a directory is complete once a file outside of it is reached.
+        # The root directory ("") contains all the others
+        groups = {}
+        # directories of the models already yielded
+        done = set()
+
+        def complete(directory):
+            names, files = groups.pop(directory)
+            # directories without any file of a model (e.g. the parent directory of the models,
+            # or a README next to them) are dropped, and can be seen again
+            if files:
+                done.add(directory)
+                yield directory, MemoryFiles(files, names)
+
+        for path, reader in self._members():
+            directory, name = posixpath.split(path.strip("/"))
+            if self.models is not None and directory not in self.models \
+                    and posixpath.basename(directory) not in self.models:
+                continue
+            for other in [other for other in groups if other != directory and other != ""
+                          and not directory.startswith(other + "/")]:
+                yield from complete(other)
+            if directory not in groups:
+                if directory in done:
+                    raise ValueError(f"The files of {directory} are not next to each other "
+                                     + f"in {self.archive}, extract the archive to load it")
+                groups[directory] = ([], {})
+            names, files = groups[directory]
+            names.append(name)
+            if name in self.wanted:
+                files[name] = reader(None)
+            elif ".ev" in self.files and name.endswith(".ev"):
+                # keep only the latest .ev file of the model
+                evs = [file for file in files if file.endswith(".ev")]
+                if latest_ev_file([name] + evs, self.prefix) == name:
+                    for file in evs:
+                        del files[file]
+                    files[name] = reader(self.EV_TAIL)
+        for directory in list(groups):
+            yield from complete(directory)
+
+
+def ReadArchivedModels(paths: list, prefix: str, index_definition, fields: list = None):
+    """Read the files of the models stored in archives, from their "path to folder" (see ArchiveModels).
+    Each archive is read once. The paths of models that are not in an archive are ignored.
+
+    Args:
+        paths (list): "path to folder" of the models
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        fields (list): optional fields loaded (see plan_files)
+
+    Yields:
+        (path to folder, files) for each model found, in the order of the archives (see MemoryFiles)
+    """
+    import os
+
+    archives = {}
+    for path in paths:
+        archive, model = split_archive_path(path)
+        if archive is not None:
+            archives.setdefault(archive, set()).add(model)
+    for archive, models in archives.items():
+        for model, files in ArchiveModels(archive, prefix, index_definition, fields, models):
+            yield os.path.join(archive, model), files
+
+
+# Loaders of the files of a model, by value of the "file" column of metadata.csv
+FILE_LOADERS = {
+    ".setup": lambda directory, prefix, index_definition, files: LoadSetupData(directory, prefix, index_definition, files),
+    ".in": lambda directory, prefix, index_definition, files: LoadInData(directory, prefix, index_definition, files),
+    "header.txt": lambda directory, prefix, index_definition, files: LoadHeaderData(directory, index_definition, files),
+    ".ev": lambda directory, prefix, index_definition, files: LoadEvData(directory, prefix, files),
+    "wind_1D.dat": lambda directory, prefix, index_definition, files: LoadWindData(directory, files),
+}
+
+# Fields without file in metadata.csv, which are computed from the data of other files (see DeriveFields)
+DERIVED_FIELDS = {"mass_ratio": [".setup"], "period": [".setup"], "binary2_p": [".setup"]}
+
+
+def source_files(index_definition, fields: list) -> list:
+    """Files of a model to read to get some fields, from the "file" column of metadata.csv
+    Args:
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        fields (list): labels of the fields
+    Returns:
+        list of keys of FILE_LOADERS, in the order they are loaded
+    """
+    properties = index_definition["mappings"]["properties"]
+    files = set()
+    for field in fields:
+        if field == "parameter_vector":
+            files.update(source_files(index_definition, list(SIMILARITY_FIELDS)))
+        elif field in DERIVED_FIELDS:
+            files.update(DERIVED_FIELDS[field])
+        elif field not in properties:
+            raise ValueError(f"{field} is not in the index definition, check metadata.csv")
+        elif properties[field].get("meta", {}).get("file") not in FILE_LOADERS:
+            raise ValueError(f"{field} is not read from the files of the models")
+        else:
+            files.add(properties[field]["meta"]["file"])
+    return [file for file in FILE_LOADERS if file in files]
+
+
+def LoadFiles(directory: str, prefix: str, index_definition, files: list, model_files=None) -> Dict[str, Any]:
+    """Load the data of some files of a model
+    Args:
+        directory (str): directory of the model
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        files (list): keys of FILE_LOADERS (see source_files)
+        model_files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
+    Returns:
+        dict: the fields read from the files
+    """
+    data = {}
+    for file in files:
+        data.update(FILE_LOADERS[file](directory, prefix, index_definition, model_files))
+    return data
+
+
+def BackfillFields(client, index: str, fields: list, prefix: str, index_definition) -> int:
+    """Set some fields of all the documents of an index from the files of the models,
+    e.g. after adding the fields to metadata.csv (see UpdateMapping) or changing how they are read.
+    Only the files the fields come from are read again, and only these fields are updated.
+
+    Args:
+        client: elasticsearch client
+        index (str): elastic search index
+        fields (list): labels of the fields to set
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+
+    Returns:
+        int: number of documents updated
+    """
+    from elasticsearch import helpers
+
+    files = source_files(index_definition, fields)
+
+    documents = {}
+    for hit in helpers.scan(client, index=index, query={"query": {"match_all": {}}},
+                            _source=["path to folder"]):
+        documents.setdefault(hit["_source"]["path to folder"], []).append((hit["_index"], hit["_id"]))
+
+    def models():
+        # the models in archives (see ArchiveModels) are read from them, one pass per archive
+        for path in documents:
+            if split_archive_path(path)[0] is None:
+                yield path, None
+        yield from ReadArchivedModels(list(documents), prefix, index_definition, fields)
+
+    def operations():
+        for path, model_files in models():
+            data = LoadFiles(path, prefix, index_definition, files, model_files)
+            if "parameter_vector" in fields:
+                data["parameter_vector"] = parameter_vector(data)
+            doc = {field: data[field] for field in fields if field in data}
+            if doc:
+                for index_name, id in documents[path]:
+                    yield {"_op_type": "update", "_index": index_name, "_id": id, "doc": doc}
+
+    success, _ = helpers.bulk(client, operations(), refresh=True)
+    return success
+
+
+# fields set by LoadDoc, which are not read from the files of the model
+DOC_FIELDS = ["Model name", "path to folder", "Publication"]
+
+
+def plan_files(index_definition, prefix: str, fields: list = None) -> list:
+    """Files of a model to read to load some fields, from the "file" column of metadata.csv
+    Args:
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        prefix (str): prefix used for the files
+        fields (list): labels of the fields to load, all the fields of the index definition if None
+    Returns:
+        list of keys of FILE_LOADERS, in the order they are loaded
+    """
+    properties = index_definition["mappings"]["properties"]
+    if fields is None:
+        fields = [field for field in properties
+                  if field in DERIVED_FIELDS or field == "parameter_vector"
+                  or properties[field].get("meta", {}).get("file") in FILE_LOADERS]
+    files = source_files(index_definition, [field for field in fields if field not in DOC_FIELDS])
+    # only the wind models have a wind_1D.dat file
+    if prefix != "wind":
+        files = [file for file in files if file != "wind_1D.dat"]
+    return files
+
+
+def LoadDoc(directory: str, model, prefix: str, index_definition, fields: list = None,
+            files=None) -> Dict[str, Any]:
+    """Load document from the files in the simulation directory.
+    Only the files containing the fields of the index definition are read (see plan_files).
     Args:
         directory (str): directory of the simulation
         prefix (str): prefix used for the files
         index_definition (dict): dictionary containing the mappings for the elastic search index
+        fields (list): optional labels of the fields to load, all the fields of the index definition if None.
+                       "Model name" and "path to folder" are always returned.
+        files: optional contents of the files of the model (see PrefetchModels), read from the disk if None
 
     Returns:
         dict: a dictionary containing all the field mappings
@@ -120,48 +1166,45 @@ def LoadDoc(directory: str, model, prefix: str, index_definition) -> Dict[str, A
     directory = os.path.join(directory, model)
     
     # create mappings for the model 
-    modelData = {"Model name": model,
+    modelData = {"Model name": os.path.basename(model),
                  "path to folder": directory,
                  "Publication": "Unpublished"}   
     
-    # get data from the .setup file
-    modelData.update(LoadSetupData(directory, prefix, index_definition))
-
-    # get data from the .in file
-    modelData.update(LoadInData(directory, prefix, index_definition))
-
-    # get data from the header.txt file
-    modelData.update(LoadHeaderData(directory, index_definition))
-
-    # get data from the .ev file
-    modelData.update(LoadEvData(directory, prefix))
-
-    # get data from the wind1D.dat file
-    if prefix == "wind":
-        modelData.update(LoadWindData(directory))
+    # get data from the .setup, .in, header.txt, .ev and wind_1D.dat files, if they contain needed fields
+    modelData.update(LoadFiles(directory, prefix, index_definition,
+                               plan_files(index_definition, prefix, fields), files))
+
+    # normalised parameter vector for similarity searches
+    if "parameter_vector" in index_definition["mappings"]["properties"] \
+            and (fields is None or "parameter_vector" in fields):
+        modelData["parameter_vector"] = parameter_vector(modelData)
+
+    if fields is not None:
+        modelData = {field: value for field, value in modelData.items()
+                     if field in fields or field in ["Model name", "path to folder"]}
     
     return modelData
 
 
-def LoadInData(directory: str, prefix: str, index_definition) -> Dict[str, Any]:
+def LoadInData(directory: str, prefix: str, index_definition, files=None) -> Dict[str, Any]:
     """Load the .in file to get the required information about the model
 
     Args:
         directory (str): directory of the simulation
         prefix (str): prefix used for the files
         index_definition (dict): dictionary containing the mappings for the elastic search index
+        files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
 
     Returns:
         dict: a dictionary containing the info from the setup and .in files
         (!! check units, they are not all in SI or cgs)
     """
-    import os
     import sys
 
     ini = {}
     # load the prefix.in file
     try:
-        with open(os.path.join(directory, "%s.in" % prefix), "r") as data:
+        with open_model_file(directory, "%s.in" % prefix, files) as data:
             for line in data:
                 if len(line) <= 1 or line.startswith("#"):
                     # remove empty lines and headers
@@ -185,28 +1228,61 @@ def LoadInData(directory: str, prefix: str, index_definition) -> Dict[str, Any]:
     return ini
 
 
-def LoadSetupData(directory: str, prefix: str, index_definition) -> Dict[str, Any]:
+# raw quantities of the .setup file needed to derive the parameters of triples
+# (not stored in the index), {label in the .setup file: name used in DeriveFields}
+TRIPLE_SETUP_LABELS = {
+    "q2": "q2",
+    "racc2b": "racc2b", "accr2b": "racc2b",
+    "Teff2b": "Teff2b",
+    "Reff2b": "Reff2b",
+    "racc2a": "racc2a", "accr2a": "racc2a",  # for subst=12
+    "Teff2a": "Teff2a",  # for subst=12
+    "Reff2a": "Reff2a",  # for subst=12
+}
+
+
+def LoadSetupData(directory: str, prefix: str, index_definition, files=None) -> Dict[str, Any]:
     """Load the .setup file to get the required information about the model
 
     Args:
         directory (str): directory of the simulation
         prefix (str): prefix used for the files
         index_definition (dict): dictionary containing the mappings for the elastic search index
+        files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
 
     Returns:
         dict: a dictionary containing the info from the setup and .in files
         (!! check units, they are not all in SI or cgs)
     """
-    import os
-    import sys
+    setup, extras = ReadSetupData(directory, prefix, index_definition, files)
 
-    import numpy as np
+    # Some calculated fields for binaries/triples
+    setup.update(DeriveFields([setup], [extras])[0])
+
+    return setup
+
+
+def ReadSetupData(directory: str, prefix: str, index_definition, files=None) -> tuple:
+    """Read the .setup file, without computing the derived fields (see DeriveFields)
+
+    Args:
+        directory (str): directory of the simulation
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+        files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
+
+    Returns:
+        dict: the fields of the index found in the .setup file
+        dict: the raw quantities needed for triples (see TRIPLE_SETUP_LABELS)
+    """
+    import sys
 
     setup = {}
+    extras = {}
 
     # load the .setup file
     try:
-        with open(os.path.join(directory, "%s.setup" % prefix), "r") as data:
+        with open_model_file(directory, "%s.setup" % prefix, files) as data:
             for line in data:
                 if len(line) <= 1 or line.startswith("#"):
                     # remove empty lines and headers
@@ -215,13 +1291,8 @@ def LoadSetupData(directory: str, prefix: str, index_definition) -> Dict[str, An
                 label, _, value, *_ = line.strip().split()
 
                 #quantities that we need for triples
-                if label =='q2': q2 = float(value)
-                elif label == "racc2b" or label == "accr2b": racc2b = float(value)
-                elif label == "Teff2b": Teff2b = float(value)
-                elif label == "Reff2b": Reff2b = float(value)
-                elif label == "racc2a" or label == "accr2a": racc2a = float(value) #for subst=12
-                elif label == "Teff2a": Teff2a = float(value) #for subst=12
-                elif label == "Reff2a": Reff2a = float(value) #for subst=12
+                if label in TRIPLE_SETUP_LABELS:
+                    extras[TRIPLE_SETUP_LABELS[label]] = float(value)
 
                 # Store variable with the type defined in the index
                 if label in index_definition["mappings"]["properties"]:
@@ -233,57 +1304,395 @@ def LoadSetupData(directory: str, prefix: str, index_definition) -> Dict[str, An
         print("")
         sys.exit()
 
-    # Some calculated fields for binaries/triples
-    if setup["icompanion_star"] >= 1:
-                setup["mass_ratio"] = float(setup["secondary_mass"]/setup["primary_mass"])
-                setup["period"] = calculate_period(setup["semi_major_axis"], setup["primary_mass"], setup["secondary_mass"])
-    
-    # For triples, get the correct stellar parameters based on the value of subst
-    if setup["icompanion_star"] == 2:
-        setup["binary2_p"] = calculate_period(setup["binary2_a"], setup["primary_mass"], setup["secondary_mass"])
-        if setup['subst'] == 11:  
-            #primary mass Mp is divided into m1 and m2, with Mp=m1+m2 and q=m2/m1, so m1=Mp/(1+q)
-            setup["primary_mass"] = np.round(float(setup["primary_mass"]/(1+q2)),3)
-            #tertiary mass is the original secondary
-            setup["tertiary_mass"] = setup["secondary_mass"]
-            setup["tertiary_racc"] = setup["secondary_racc"]
-            setup["tertiary_Teff"] = setup["secondary_Teff"]
-            setup["tertiary_Reff"] = setup["secondary_Reff"]
-            #secondary mass is m1*q
-            setup["secondary_mass"] = np.round(float(setup["primary_mass"]*q2),3)
-            setup["secondary_racc"] = racc2b
-            setup["secondary_Teff"] = Teff2b
-            setup["secondary_Reff"] = Reff2b
-
-        elif setup['subst']==12: #primary mass is original primary mass, original secondary is divided into m2 and m3
-            setup["secondary_mass"] = np.round(float(setup["secondary_mass"]/(1+q2)),3)
-            setup["tertiary_mass"] = np.round(float(setup["secondary_mass"]*q2),3)
-            setup["secondary_racc"] = racc2a
-            setup["tertiary_racc"] = racc2b
-            setup["secondary_Teff"] = Teff2a
-            setup["tertiary_Teff"] = Teff2b
-            setup["secondary_Reff"] = Reff2a
-            setup["tertiary_Reff"] = Reff2b
+    return setup, extras
 
-    return setup
 
-def LoadHeaderData(directory: str, index_definition) -> Dict[str, Any]:
+def DeriveFields(setups: list, extras: list) -> list:
+    """Compute the derived fields of a batch of models in one pass, over arrays:
+    mass ratio and periods of binaries/triples, and the stellar parameters of triples based on the value of subst.
+
+    Args:
+        setups (list): dictionaries of the fields read in the .setup file of each model (see ReadSetupData)
+        extras (list): dictionaries of the raw triple quantities of each model (see ReadSetupData)
+
+    Returns:
+        list: a dictionary of derived fields for each model, to update its setup dictionary with
+    """
+    import numpy as np
+
+    n = len(setups)
+
+    def column(rows, key):
+        # missing values are NaN, so they fail every test below
+        return np.array([row.get(key, np.nan) for row in rows], dtype=float)
+
+    icomp = column(setups, "icompanion_star")
+    subst = column(setups, "subst")
+    m1 = column(setups, "primary_mass")
+    m2 = column(setups, "secondary_mass")
+    q2 = column(extras, "q2")
+
+    binary = icomp >= 1
+    triple = icomp == 2
+    subst11 = triple & (subst == 11)
+    subst12 = triple & (subst == 12)
+
+    # field: list of (models concerned, values)
+    derived = {}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        derived["mass_ratio"] = [(binary, m2 / m1)]
+        derived["period"] = [(binary, calculate_period(column(setups, "semi_major_axis"), m1, m2))]
+        derived["binary2_p"] = [(triple, calculate_period(column(setups, "binary2_a"), m1, m2))]
+
+        # subst=11: primary mass Mp is divided into m1 and m2, with Mp=m1+m2 and q=m2/m1, so m1=Mp/(1+q)
+        # the tertiary is the original secondary, and the secondary mass is m1*q
+        m1_11 = np.round(m1 / (1 + q2), 3)
+        # subst=12: primary is the original primary, the original secondary is divided into m2 and m3
+        m2_12 = np.round(m2 / (1 + q2), 3)
+
+        derived["primary_mass"] = [(subst11, m1_11)]
+        derived["secondary_mass"] = [(subst11, np.round(m1_11 * q2, 3)), (subst12, m2_12)]
+        derived["tertiary_mass"] = [(subst11, m2), (subst12, np.round(m2_12 * q2, 3))]
+        for quantity in ["racc", "Teff", "Reff"]:
+            derived[f"secondary_{quantity}"] = [(subst11, column(extras, f"{quantity}2b")),
+                                                (subst12, column(extras, f"{quantity}2a"))]
+            derived[f"tertiary_{quantity}"] = [(subst11, column(setups, f"secondary_{quantity}")),
+                                               (subst12, column(extras, f"{quantity}2b"))]
+
+    results = [{} for _ in range(n)]
+    for field, cases in derived.items():
+        for mask, values in cases:
+            for i in np.nonzero(mask & ~np.isnan(values))[0]:
+                results[i][field] = float(values[i])
+    return results
+
+
+def RecomputeDerivedFields(client, index: str, prefix: str, index_definition) -> int:
+    """Recompute the fields derived from the .setup files of all the documents of an index,
+    e.g. after a change in DeriveFields. The .setup files are read again from the "path to folder"
+    of each document, and the documents are updated in place.
+
+    Args:
+        client: elasticsearch client
+        index (str): elastic search index
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the mappings for the elastic search index
+
+    Returns:
+        int: number of documents updated
+    """
+    from elasticsearch import helpers
+
+    documents = {}
+    for hit in helpers.scan(client, index=index, query={"query": {"match_all": {}}},
+                            _source=["path to folder"]):
+        documents.setdefault(hit["_source"]["path to folder"], []).append(hit["_id"])
+
+    # the models in archives (see ArchiveModels) are read from them, one pass per archive
+    archived = dict(ReadArchivedModels(list(documents), prefix, index_definition,
+                                       fields=list(DERIVED_FIELDS)))
+    ids = []
+    setups = []
+    extras = []
+    for path, path_ids in documents.items():
+        if split_archive_path(path)[0] is not None and path not in archived:
+            print(f"{path} not found in its archive, skipped")
+            continue
+        setup, extra = ReadSetupData(path, prefix, index_definition, archived.get(path))
+        for id in path_ids:
+            ids.append(id)
+            setups.append(setup)
+            extras.append(extra)
+
+    # all the models in one pass
+    derived = DeriveFields(setups, extras)
+
+    operations = [{"_op_type": "update", "_index": index, "_id": id, "doc": setup | fields}
+                  for id, setup, fields in zip(ids, setups, derived)]
+    success, _ = helpers.bulk(client, operations, refresh=True)
+    return success
+
+
+# settings of an index while it is bulk loaded: no refresh and no replica until the load is done
+BULK_LOAD_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+
+def next_index_version(client, alias: str) -> str:
+    """Name of the next version of an index, alias_vN with N one more than the existing versions
+    Args:
+        client: elasticsearch client
+        alias (str): name of the alias (e.g. "wind")
+    Returns:
+        str: name of the new index (e.g. "wind_v3")
+    """
+    import re
+
+    versions = [int(match.group(1)) for name in client.indices.get(index=f"{alias}_v*")
+                if (match := re.fullmatch(re.escape(alias) + r"_v(\d+)", name))]
+    return f"{alias}_v{max(versions, default=0) + 1}"
+
+
+def CreateVersionedIndex(client, alias: str, index_definition) -> str:
+    """Create a new version of an index, set up for bulk loading (see BULK_LOAD_SETTINGS).
+    The alias is not moved, so the index is not visible to the dashboard until SwapAlias is called.
+
+    Args:
+        client: elasticsearch client
+        alias (str): name of the alias the index will be published under (e.g. "wind")
+        index_definition (dict): dictionary containing the settings and mappings of the index
+
+    Returns:
+        str: name of the new index
+    """
+    index = next_index_version(client, alias)
+    settings = index_definition.get("settings", {}) | BULK_LOAD_SETTINGS
+    client.indices.create(index=index, settings=settings, mappings=index_definition["mappings"])
+    return index
+
+
+def FinaliseIndex(client, index: str, index_definition):
+    """Restore the settings of an index after bulk loading, refresh it and merge its segments.
+    The refresh interval and number of replicas are taken from the index definition,
+    or reset to the defaults of Elasticsearch if it does not set them.
+
+    Args:
+        client: elasticsearch client
+        index (str): name of the index
+        index_definition (dict): dictionary containing the settings and mappings of the index
+    """
+    settings = index_definition.get("settings", {})
+    client.indices.put_settings(index=index, settings={
+        key: settings.get(key) for key in BULK_LOAD_SETTINGS
+    })
+    client.indices.refresh(index=index)
+    # the index is no longer written to, a single segment makes the searches faster
+    client.indices.forcemerge(index=index, max_num_segments=1)
+    client.cluster.health(index=index, wait_for_status="yellow", timeout="5m")
+
+
+def check_alias(client, alias: str, replace_index: bool = False):
+    """Raise a ValueError if the alias can't be created: an index has its name (e.g. an index
+    created before the versioned indices) and replace_index is False (see SwapAlias).
+    Checked before loading a new version of the index, so it fails before anything is loaded.
+    """
+    if not replace_index and not client.indices.exists_alias(name=alias) \
+            and client.indices.exists(index=alias):
+        raise ValueError(f"{alias} is an index, use replace_index=True to replace it by an alias")
+
+
+def SwapAlias(client, alias: str, index: str, replace_index: bool = False) -> list:
+    """Point an alias to an index, in a single atomic operation, so the searches
+    go either to the old or to the new index.
+
+    Args:
+        client: elasticsearch client
+        alias (str): name of the alias (e.g. "wind")
+        index (str): name of the index the alias should point to
+        replace_index (bool): if an index has the name of the alias (e.g. an index created
+            before the versioned indices), delete it in the same operation. Otherwise raise a ValueError.
+
+    Returns:
+        list: names of the indices the alias pointed to before, which can be deleted
+    """
+    actions = [{"add": {"index": index, "alias": alias}}]
+    if client.indices.exists_alias(name=alias):
+        previous = [name for name in client.indices.get_alias(name=alias) if name != index]
+        actions = [{"remove": {"index": name, "alias": alias}} for name in previous] + actions
+    elif client.indices.exists(index=alias):
+        check_alias(client, alias, replace_index)
+        previous = []
+        actions = [{"remove_index": {"index": alias}}] + actions
+    else:
+        previous = []
+    client.indices.update_aliases(actions=actions)
+    return previous
+
+
+def ReindexModels(client, alias: str, directory: str, models: list, prefix: str, index_definition,
+                  publications: dict = None, replace_index: bool = False, source=None) -> str:
+    """Rebuild an index from the simulation files, without disturbing the searches on the current one.
+    The models are loaded into a new version of the index (alias_vN) set up for bulk loading,
+    which replaces the current index under the alias once it is complete.
+
+    Args:
+        client: elasticsearch client
+        alias (str): name of the alias searched by the dashboard (e.g. "wind")
+        directory (str): directory containing the models
+        models (list): names of the models to load
+        prefix (str): prefix used for the files
+        index_definition (dict): dictionary containing the settings and mappings of the index
+        publications (dict): optional {model name: publication}, set before the index is published
+        replace_index (bool): see SwapAlias
+        source: optional iterable of (model, files) to load the models from, e.g. ArchiveModels.
+                By default the models are read from directory with PrefetchModels.
+
+    Returns:
+        str: name of the new index. The previous versions are kept, to go back to them if needed.
+    """
+    from elasticsearch import helpers
+
+    publications = publications or {}
+    # fail now rather than after loading all the models
+    check_alias(client, alias, replace_index)
+    index = CreateVersionedIndex(client, alias, index_definition)
+
+    def documents():
+        # the files of the next models are read while the current one is loaded
+        for model, files in source or PrefetchModels(directory, models, prefix, index_definition):
+            modelData = LoadDoc(directory, model, prefix, index_definition, files=files)
+            CheckEntries(model, modelData)
+            if model in publications:
+                modelData["Publication"] = publications[model]
+            yield {"_index": index, "_op_type": "index", "_source": modelData}
+
+    complete = False
+    try:
+        helpers.bulk(client, documents())
+        FinaliseIndex(client, index, index_definition)
+        complete = True
+    finally:
+        if not complete:
+            # the alias still points to the previous index, remove the incomplete one, also when
+            # a loader exits (sys.exit raises SystemExit) or the upload is interrupted
+            client.indices.delete(index=index)
+    SwapAlias(client, alias, index, replace_index)
+    return index
+
+
+def SaveSnapshot(client, index: str, path: str) -> int:
+    """Save all the documents of an index to a SQLite file, read by the dashboard when
+    Elasticsearch is unavailable (see dashboard/snapshot.py). Run it after each upload.
+    The file is replaced at once, the dashboard never reads a partial snapshot.
+
+    Args:
+        client: elasticsearch client
+        index (str): elastic search index (or alias)
+        path (str): path of the snapshot file
+
+    Returns:
+        int: number of documents saved
+    """
+    import json
+    import os
+    import sqlite3
+    from datetime import datetime, timezone
+
+    from elasticsearch import helpers
+
+    temporary = path + ".tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    connection = sqlite3.connect(temporary)
+    try:
+        connection.execute("CREATE TABLE documents (id TEXT PRIMARY KEY, source TEXT)")
+        connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+        # scan returns the documents in index order (_doc)
+        connection.executemany("INSERT INTO documents VALUES (?, ?)", (
+            (hit["_id"], json.dumps(hit["_source"]))
+            for hit in helpers.scan(client, index=index, query={"query": {"match_all": {}}})))
+        count = connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        connection.executemany("INSERT INTO info VALUES (?, ?)", [
+            ("index", index),
+            ("created", datetime.now(timezone.utc).isoformat()),
+            ("count", str(count)),
+        ])
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temporary, path)
+    return count
+
+
+# mapping parameters compared by DiffMapping, with their default value in Elasticsearch.
+# Only meta can be changed on an existing field, the others need a new index (see ReindexModels)
+MAPPING_PARAMETERS = {"type": None, "format": None, "scaling_factor": None, "index": True,
+                      "doc_values": True, "dims": None, "similarity": None, "fields": {}, "meta": {}}
+
+
+def DiffMapping(client, index: str, index_definition) -> Dict[str, Any]:
+    """Compare the mappings and index sort of index_definition (from metadata.csv) with those of an index.
+
+    Args:
+        client: elasticsearch client
+        index (str): name of the index or alias
+        index_definition (dict): dictionary containing the settings and mappings of the index
+
+    Returns:
+        dict with
+            "added": {field: mapping} of the fields missing from the index, which can be added
+            "updated": {field: mapping} of the fields whose meta changed, which can be updated
+            "conflicts": {field: description} of the changes that need a new index (see ReindexModels)
+            "unmapped": fields of the index which are not in index_definition
+    """
+    properties = index_definition["mappings"]["properties"]
+    diff = {"added": {}, "updated": {}, "conflicts": {}, "unmapped": []}
+
+    for name, mapping in client.indices.get_mapping(index=index).items():
+        live = mapping["mappings"].get("properties", {})
+        diff["unmapped"] += [field for field in live
+                             if field not in properties and field not in diff["unmapped"]]
+        for field, definition in properties.items():
+            if field not in live:
+                diff["added"][field] = definition
+                continue
+            changed = [parameter for parameter, default in MAPPING_PARAMETERS.items()
+                       if live[field].get(parameter, default) != definition.get(parameter, default)]
+            if changed == ["meta"]:
+                diff["updated"][field] = definition
+            elif changed:
+                diff["conflicts"][field] = ", ".join(
+                    f"{parameter}: {live[field].get(parameter, MAPPING_PARAMETERS[parameter])} in {name}, "
+                    + f"{definition.get(parameter, MAPPING_PARAMETERS[parameter])} in metadata.csv"
+                    for parameter in changed)
+
+    # the sort of an index is set when it is created
+    sort = index_definition.get("settings", {}).get("sort.field")
+    for name, settings in client.indices.get_settings(index=index, name="index.sort.*").items():
+        live_sort = settings["settings"].get("index", {}).get("sort", {}).get("field")
+        if isinstance(live_sort, str):
+            live_sort = [live_sort]
+        if live_sort != sort:
+            diff["conflicts"]["index sort"] = f"{live_sort} in {name}, {sort} in metadata.csv"
+    return diff
+
+
+def UpdateMapping(client, index: str, index_definition) -> Dict[str, Any]:
+    """Update the mappings of an existing index with the new fields and metadata of index_definition,
+    without recreating the index. Changes that need a new index are only reported.
+    The new fields are empty in the existing documents until they are loaded again.
+
+    Args:
+        client: elasticsearch client
+        index (str): name of the index or alias
+        index_definition (dict): dictionary containing the settings and mappings of the index
+
+    Returns:
+        dict: differences between the index and index_definition (see DiffMapping)
+    """
+    diff = DiffMapping(client, index, index_definition)
+    changes = diff["added"] | diff["updated"]
+    if changes:
+        client.indices.put_mapping(index=index, properties=changes)
+    return diff
+
+
+def LoadHeaderData(directory: str, index_definition, files=None) -> Dict[str, Any]:
     '''Load the header.txt file to get the required information about the model
     Args:
         directory: directory of the simulation
         index_definition: dictionary containing the mappings for the elastic search index
+        files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
     
     Returns:
         dict: a dictionary containing the info from the header.txt file
     '''
 
-    import os
     import sys
 
     header = {}
 
     try:
-        with open(os.path.join(directory, "header.txt"), "r") as data:
+        with open_model_file(directory, "header.txt", files) as data:
             for line in data:
                 if len(line) <= 1 \
                 or line.startswith("#") \
@@ -334,46 +1743,36 @@ def LoadHeaderData(directory: str, index_definition) -> Dict[str, Any]:
         return
     return header
     
-def LoadEvData(directory: str, prefix: str) -> Dict[str, Any]:
+def LoadEvData(directory: str, prefix: str, files=None) -> Dict[str, Any]:
     """Load the .ev file to get the required information about the model
     Args:
         directory (str): directory of the simulation
         prefix (str): prefix used for the files
         index_definition (dict): dictionary containing the mappings for the elastic search index
+        files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
 
     Returns:
         dict: a dictionary containing the info from the .ev file
     """
-    import glob
-    import os
     import sys
 
     ev = {}
 
     # find latest .ev file
     # find all files matching the pattern wind*.ev
-    ev_files = glob.glob( "*.ev",root_dir=directory)
+    ev_files = [file for file in list_model_files(directory, files) if file.endswith(".ev")]
     if not ev_files:
         print("ERROR: %s No *.ev files found!"% directory)
         sys.exit()
 
-    # extract the number from the filenames and find the one with the largest number
-    max_number = -1
-    max_file = None
-    for file in ev_files:
-        try:
-            number = int(file.split(prefix)[1].split(".ev")[0])
-            if number > max_number:
-                max_number = number
-                max_file = file
-        except ValueError:
-            continue
+    # the one with the largest number
+    max_file = latest_ev_file(ev_files, prefix)
 
     if max_file is None:
         print("ERROR: %s No valid wind*.ev files found!" % directory)
         sys.exit()
 
-    with open(os.path.join(directory, max_file), "r") as data:
+    with open_model_file(directory, max_file, files) as data:
         # everything we need is in the last line
         cu_to_yr = 0.15916423881616068 # according to splash units (code units are set such that G=1)
 
@@ -383,16 +1782,16 @@ def LoadEvData(directory: str, prefix: str) -> Dict[str, Any]:
     return ev
 
 
-def LoadWindData(directory: str) -> Dict[str, Any]:
+def LoadWindData(directory: str, files=None) -> Dict[str, Any]:
     """Load the wind1D.data file to get the required information about the model
 
     Args:
         directory (str): directory of the simulation
+        files: optional contents of the files of the model (see MemoryFiles), read from the disk if None
 
     Returns:
         dict: a dictionary containing the info from the setup and .in files
     """
-    import os
     import sys
 
     cm_to_km = 1e-5
@@ -400,7 +1799,7 @@ def LoadWindData(directory: str) -> Dict[str, Any]:
     wind = {}
     # load the prefix.in file
     try:
-        with open(os.path.join(directory, "wind_1D.dat"), "r") as data:
+        with open_model_file(directory, "wind_1D.dat", files) as data:
             # everything we need is in the last line
             line = data.readlines()[-1]
             # Get wind terminal velocity
@@ -408,7 +1807,7 @@ def LoadWindData(directory: str) -> Dict[str, Any]:
             
     except FileNotFoundError:
         try:
-            with open(os.path.join(directory, "windprofile1D.dat"), "r") as data:
+            with open_model_file(directory, "windprofile1D.dat", files) as data:
                 # Get wind terminal velocity (in km/s, it's in cm/s in the file)
                 line = data.readlines()[-1]
                 wind['wind_terminal_velocity'] = float(line.strip().split()[2])*cm_to_km
@@ -420,7 +1819,7 @@ def LoadWindData(directory: str) -> Dict[str, Any]:
 def StoreEntry(index_definition: dict, label:str, value:str):
     """Store the entry in the elastic search database if it appears in the index_definition.
     The variable type is then based on the entry type defined in index_definition. 
-    For now only string, integer and float are supported.
+    For now only string, integer, float (or scaled_float) and date are supported.
     Args:
         index_definition (dict): dictionary containing the mappings for the elastic search index
         label (str): label of the entry
@@ -429,7 +1828,7 @@ def StoreEntry(index_definition: dict, label:str, value:str):
     import sys
 
     # Return variable with the type defined in the index dictionary
-    if index_definition["mappings"]["properties"][label]["type"] == "float":
+    if index_definition["mappings"]["properties"][label]["type"] in ["float", "scaled_float"]:
         return float(value)
     elif index_definition["mappings"]["properties"][label]["type"] == "integer":
         return int(value)